@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+# Precision-driven adaptive stopping of campaigns: runs are added to a
+# configuration until the medians of its longitudinal outputs are known well enough
+
+import asyncio
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+
+# Limit of X used for the plots in analysis.py
+X_LIMIT = 1030
+
+# Bootstrap resamples for the uncertainty of the medians, processed in chunks
+N_BOOT = 200
+BOOT_CHUNK = 20
+
+# Profile columns as plotted by analysis.py profile()
+PROFILE_COLS = {"ep": ["electron", "positron"],
+                "muon": ["muplus", "muminus"],
+                "photon": ["photon"],
+                "hadron": ["hadron"]}
+
+
+# Per-shower values of the energy loss and profile columns of one run, as
+# {column: DataFrame with one row per shower and one column per X < X_LIMIT}
+def run_values(run_dir):
+    values = {}
+
+    eloss = pd.read_parquet(os.path.join(run_dir, "energyloss", "dEdX.parquet"), "pyarrow",
+        columns=["shower", "X", "total"])
+    eloss = eloss[eloss["X"] < X_LIMIT]
+    values["total"] = eloss.pivot_table(index="shower", columns="X", values="total")
+
+    needed = sum(PROFILE_COLS.values(), [])
+    prof = pd.read_parquet(os.path.join(run_dir, "profile", "profile.parquet"), "pyarrow",
+        columns=["shower", "X"] + needed)
+    prof = prof[prof["X"] < X_LIMIT]
+    for col, parts in PROFILE_COLS.items():
+        prof[col] = prof[parts].sum(axis=1)
+        values[col] = prof.pivot_table(index="shower", columns="X", values=col)
+
+    return values
+
+
+# Largest relative interquartile width of the bootstrapped medians over all X
+# bins with a non-zero median
+def relative_width(matrix, rng):
+    n = matrix.shape[0]
+    median = np.median(matrix, axis=0)
+
+    boot = []
+    for start in range(0, N_BOOT, BOOT_CHUNK):
+        idx = rng.integers(0, n, (min(BOOT_CHUNK, N_BOOT - start), n))
+        boot.append(np.median(matrix[idx], axis=1))
+    q25, q75 = np.quantile(np.concatenate(boot), [0.25, 0.75], axis=0)
+
+    valid = median > 0
+    if not valid.any():
+        return 0.0
+    return float(np.max((q75 - q25)[valid] / median[valid]))
+
+
+# Adds runs to campaign configurations until the target precision is reached,
+# registered as a completion hook of the scheduler before the merger
+class Controller:
+    def __init__(self, runner, merger, extend, target, max_runs, batch):
+        self.runner = runner
+        self.merger = merger
+        # Function creating and queueing jobs of new runs: extend(config, n_new) -> jobs
+        self.extend = extend
+        # Default target relative width, maximum number of runs and runs added at once
+        self.target = target
+        self.max_runs = max_runs
+        self.batch = batch
+        self.configs = {}
+        self.settings = {}
+        self.remaining = {}
+        self.failed = {}
+        # Cached per-run values, read once per run
+        self.cache = {}
+
+    # Track a configuration with the given number of pending runs
+    def add(self, config, n_pending, target=None, max_runs=None):
+        self.configs[config.name] = config
+        self.settings[config.name] = (target or self.target, max_runs or self.max_runs)
+        self.remaining[config.name] = n_pending
+        self.failed[config.name] = 0
+        self.cache[config.name] = {}
+
+    # Relative width of the medians over all columns, from all complete runs
+    def width(self, name):
+        config = self.configs[name]
+        sim_output = os.path.join(self.merger.output_dir, name)
+        cache = self.cache[name]
+
+        for run in range(config.runs):
+            run_dir = os.path.join(sim_output, "run_" + str(run))
+            if run not in cache and os.path.isfile(os.path.join(run_dir, "summary.yaml")):
+                cache[run] = run_values(run_dir)
+
+        if not cache:
+            return math.inf, 0
+
+        rng = np.random.default_rng(0)
+        width = 0.0
+        for col in cache[next(iter(cache))]:
+            frame = pd.concat([values[col] for values in cache.values()]).dropna(axis=1)
+            width = max(width, relative_width(frame.to_numpy(), rng))
+
+        return width, len(cache)
+
+    # Decide whether a configuration needs more runs and return the new jobs
+    async def evaluate(self, name):
+        if self.failed[name]:
+            return []
+
+        target, max_runs = self.settings[name]
+        width, n = await asyncio.to_thread(self.width, name)
+
+        if width <= target:
+            print("\033[2K\r  - {}: relative IQR of medians {:.3f} <= {} after {} run(s), done".format(name, width, target, n))
+            return []
+        if n >= max_runs:
+            print("\033[2K\r  - {}: relative IQR of medians {:.3f} after {} run(s), maximum reached".format(name, width, n))
+            return []
+
+        # Width of the medians scales as 1/sqrt(n)
+        n_needed = math.ceil(n * (width / target) ** 2) if n else self.batch
+        n_new = max(min(n_needed - n, max_runs - n, self.batch), 1)
+        print("\033[2K\r  - {}: relative IQR of medians {:.3f} > {} after {} run(s), adding {}".format(name, width, target, n, n_new))
+
+        config = self.configs[name]
+        jobs = self.extend(config, n_new)
+        self.configs[name] = jobs[0].config
+        self.remaining[name] += len(jobs)
+        self.merger.remaining[name] += len(jobs)
+        return jobs
+
+    # Completion hook of the scheduler
+    async def __call__(self, job, ok):
+        name = job.config.name
+        if name not in self.remaining:
+            return
+
+        self.remaining[name] -= 1
+        if not ok:
+            self.failed[name] += 1
+        if self.remaining[name] == 0:
+            jobs = await self.evaluate(name)
+            if jobs:
+                await self.runner.add_jobs(jobs)
+
+    # New runs for configurations that had no pending runs to begin with
+    async def initial_jobs(self):
+        jobs = []
+        for name, n in self.remaining.items():
+            if n == 0:
+                jobs += await self.evaluate(name)
+        return jobs
@@ -1,19 +1,96 @@
 #!/usr/bin/python3
 # Script for analysis of Corsika8 outputs
 
+import glob
+import json
+import math
 import os
 import sys
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 from scipy.stats import norm
 import matplotlib.lines as mlines
 from matplotlib import pyplot as plt
 
+from merge_outputs import DATASET, FAMILIES, HIST_EDGES, HIST_FAMILIES, HISTOGRAMS, Histograms
+
 
 def print_usage():
     print("Usage: python3 analysis.py [plot-dir] [sim-names]")
     print("Example: python3 analysis.py pdg22 pdg22_E100 pdg22_E1000")
 
+# Read an output of a simulation through pyarrow.dataset, reading only the given
+# columns and the row groups (and partitions) that can match the filter. Merged
+# outputs written with --dataset are read from the partitioned dataset, otherwise
+# from the merged file and its appended segments (or the direct C8 output).
+def load(path, mod, columns=None, filter=None):
+    if os.path.isdir(path + DATASET + "/" + mod):
+        source = ds.dataset(path + DATASET + "/" + mod, format="parquet", partitioning="hive")
+    else:
+        files = [path + mod + "/" + output_types[mod] + ".parquet"]
+        files += sorted(glob.glob(path + mod + "/" + output_types[mod] + "_[0-9][0-9][0-9][0-9].parquet"))
+        source = ds.dataset(files, format="parquet")
+    return source.to_table(columns=columns, filter=filter).to_pandas()
+
+# Per-X summary of an output written by merge_outputs.py, only the given columns
+# and statistics, None if there is no summary (e.g. outputs merged before)
+def load_summary(path, mod, columns, stats):
+    file = path + mod + "/" + output_types[mod] + ".summary.parquet"
+    if not os.path.isfile(file):
+        return None
+    return pd.read_parquet(file, "pyarrow", columns=["X"] + [c + "_" + s for c in columns for s in stats])
+
+# Filter of particles of one type and their antiparticles, in a partitioned
+# dataset only the partition of their family is read
+def particle_filter(path, pdg):
+    filter = pc.abs(ds.field("pdg")) == pdg
+    if os.path.isdir(path + DATASET + "/particles"):
+        filter = filter & (ds.field("family") == FAMILIES[pdg])
+    return filter
+
+# Per-shower histograms of R and kinetic energy of particles of one type on the
+# fixed log axes of the merge, {axis: (edges, counts[shower, bin])} with an underflow
+# and an overflow bin. Read from the histograms written by the merge if present,
+# otherwise filled from the particles.
+def shower_histograms(path, pdg, n_showers):
+    family = FAMILIES[pdg]
+    file = path + HISTOGRAMS + ".parquet"
+    if os.path.isfile(file):
+        table = pq.read_table(file, filters=[("family", "==", family)]).sort_by("shower")
+        hists = {}
+        for axis in HIST_EDGES:
+            edges = np.array(json.loads(table.schema.metadata[(axis + "_edges").encode()]))
+            counts = table[axis].combine_chunks().flatten().to_numpy().reshape(table.num_rows, -1)
+            hists[axis] = (edges, counts)
+        return hists
+
+    particles = load(path, "particles", ["shower", "pdg", "x", "y", "kinetic_energy"], particle_filter(path, pdg))
+    filled = Histograms(n_showers)
+    filled.add(pa.Table.from_pandas(particles, preserve_index=False))
+    return {axis: (edges, filled.counts[axis][:, HIST_FAMILIES.index(family), :]) for axis, edges in HIST_EDGES.items()}
+
+# Plotted range of a histogram axis: bins of the axis with entries in the
+# reference, merged to at most n_bins. Returns the first bin, bins per plotted bin and plotted edges.
+def plot_bins(edges, counts, n_bins):
+    filled = np.flatnonzero(counts[:, 1:-1].sum(axis=0))
+    if len(filled) == 0:
+        return 0, 1, edges[:2]
+    first, end = filled[0], filled[-1] + 1
+    factor = math.ceil((end - first) / n_bins)
+    n = math.ceil((end - first) / factor)
+    return first, factor, edges[np.minimum(first + factor * np.arange(n + 1), len(edges) - 1)]
+
+# Sum per-shower histograms into the plotted bins
+def rebin(counts, first, factor, n):
+    inner = counts[:, 1 + first:1 + first + n * factor]
+    if inner.shape[1] < n * factor:
+        inner = np.pad(inner, ((0, 0), (0, n * factor - inner.shape[1])))
+    return inner.reshape(len(counts), n, factor).sum(axis=2)
+
 # lower quartile
 def q25(x):
     return x.quantile(0.25)
@@ -69,10 +146,12 @@ def energyloss():
         # Get color
         color = colors[id]
 
-        # Calculate means and SEMs for columns
-        res[path] = data[path]["energyloss"].groupby("X").agg({"total":["median", q25, q75]})
-        res[path].columns = res[path].columns.map('_'.join)
-        res[path] = res[path].reset_index()
+        # Calculate means and SEMs for columns, precomputed by the merge if available
+        res[path] = load_summary(path, "energyloss", ["total"], ["median", "q25", "q75"])
+        if res[path] is None:
+            res[path] = load(path, "energyloss", ["X", "total"]).groupby("X").agg({"total":["median", q25, q75]})
+            res[path].columns = res[path].columns.map('_'.join)
+            res[path] = res[path].reset_index()
 
         # Calculate errors and ratio vs reference
         res[path]["errH"] = res[path]["total_q75"] - res[path]["total_median"]
@@ -147,9 +226,19 @@ def production():
 
     # Iterate over runs and calculate means and SEMs for columns
     for path in sim_dir:
-        res[path] = data[path]["production_profile"].groupby("X").agg(["mean", "sem"])
-        res[path].columns = res[path].columns.map('_'.join)
-        res[path] = res[path].reset_index()
+        summ = load_summary(path, "production_profile", cols, ["count", "sum", "sumsq"])
+        if summ is not None:
+            # Means and SEMs from the sums precomputed by the merge
+            res[path] = summ[["X"]].copy()
+            for col in cols:
+                n = summ[col + "_count"]
+                res[path][col + "_mean"] = summ[col + "_sum"] / n
+                var = (summ[col + "_sumsq"] - summ[col + "_sum"]**2 / n) / (n - 1)
+                res[path][col + "_sem"] = np.sqrt(var.clip(lower=0) / n)
+        else:
+            res[path] = load(path, "production_profile", ["X"] + cols).groupby("X").agg(["mean", "sem"])
+            res[path].columns = res[path].columns.map('_'.join)
+            res[path] = res[path].reset_index()
 
         # Calculate ratio vs reference
         for col in cols:
@@ -215,14 +304,18 @@ def profile():
 
     # Iterate over runs and calculate means and SEMs for columns
     for path in sim_dir:
-        # Add values for positive and negative particles
-        data[path]["profile"]["muon"] = data[path]["profile"]["muplus"] + data[path]["profile"]["muminus"]
-        data[path]["profile"]["ep"] = data[path]["profile"]["electron"] + data[path]["profile"]["positron"]
-
-        # Calculate means and SEMs for columns
-        res[path] = data[path]["profile"].groupby("X").agg(["median", q25, q75])
-        res[path].columns = res[path].columns.map('_'.join)
-        res[path] = res[path].reset_index()
+        # Medians and quartiles precomputed by the merge if available
+        res[path] = load_summary(path, "profile", cols, ["median", "q25", "q75"])
+        if res[path] is None:
+            # Add values for positive and negative particles
+            prof = load(path, "profile", ["X", "electron", "positron", "muplus", "muminus", "photon", "hadron"])
+            prof["muon"] = prof["muplus"] + prof["muminus"]
+            prof["ep"] = prof["electron"] + prof["positron"]
+
+            # Calculate means and SEMs for columns
+            res[path] = prof.groupby("X").agg(["median", q25, q75])
+            res[path].columns = res[path].columns.map('_'.join)
+            res[path] = res[path].reset_index()
 
         # Calculate errors and ratio vs reference
         for col in cols:
@@ -343,16 +436,26 @@ def observation():
     T_25pers = {}
     T_75pers = {}
 
-    # Iterate over sims
+    # Per-shower histograms of R and kinetic energy of each sim and particle type
+    hists = {}
     for path in sim_dir:
-        # Calculate R from (x,y)
-        data[path]["particles"]["R"] = pow(pow(data[path]["particles"]["x"],2) + pow(data[path]["particles"]["y"],2), 0.5)
-
-        res[path] = data[path]["particles"]
-
         # get number of runs (=showers)
-        n_runs = int(res[path].max()["shower"] + 1)
+        n_runs = int(data[path]["runtime"]["showers"].sum())
+        hists[path] = [shower_histograms(path, pdg[p], n_runs) for p in range(len(cols))]
+
+    # histogram binning from reference data, per particle type
+    R_bins = []
+    T_bins = []
+    binning = []
+    for p in range(len(cols)):
+        R_first, R_factor, R_edges = plot_bins(*hists[ref][p]["R"], n_bins)
+        T_first, T_factor, T_edges = plot_bins(*hists[ref][p]["kinetic_energy"], n_bins)
+        R_bins.append(R_edges)
+        T_bins.append(T_edges)
+        binning.append((R_first, R_factor, T_first, T_factor))
 
+    # Iterate over sims
+    for path in sim_dir:
         # add empty dictionaries for this sim
         R_medians[path] = {}
         R_25pers[path] = {}
@@ -363,72 +466,19 @@ def observation():
 
         # process for particle types
         for p in range(len(cols)):
-            # filter dataframe for particle type
-            filt_part = res[path][abs(res[path]["pdg"]) == pdg[p]]
-
-            # get minima and maxima for histogram binning from reference data
-            if (path == ref):
-                R_min = 0
-                R_max = filt_part["R"].quantile(0.99)
-                T_min = filt_part["kinetic_energy"].quantile(0.0001)
-                T_max = filt_part["kinetic_energy"].quantile(0.999)
-
-                # histogram binning
-                R_bins = np.linspace(R_min, R_max, n_bins+1)
-                T_bins = np.logspace(np.log10(T_min), np.log10(T_max), n_bins+1)
-
-            # prepare median and IQR histograms
-            R_meds = np.zeros(n_bins)
-            R_75p = np.zeros(n_bins)
-            R_25p = np.zeros(n_bins)
-            T_meds = np.zeros(n_bins)
-            T_75p = np.zeros(n_bins)
-            T_25p = np.zeros(n_bins)
-
-            # arrays for histograms from individual runs
-            R_hists = []
-            T_hists = []
-
-            # collect histograms from individual runs
-            for r in range(n_runs):
-                # filter dataframe for each run
-                filt_run = filt_part[filt_part["shower"] == r]
-
-                # get histogram of R and kinetic energy
-                R_hist, _ = np.histogram(filt_run["R"], R_bins)
-                T_hist, _ = np.histogram(filt_run["kinetic_energy"], T_bins)
-
-                # store histograms
-                R_hists.append(R_hist)
-                T_hists.append(T_hist)
-
-            # process histograms and get median values
-            for b in range(n_bins):
-                # arrays for values in this bin
-                R_val = []
-                T_val = []
-
-                # iterate over all runs
-                for r in range(n_runs):
-                    # append values
-                    R_val.append(R_hists[r][b])
-                    T_val.append(T_hists[r][b])
-
-                # calculate median and interquartile range
-                R_median = np.median(R_val)
-                R_25per = np.quantile(R_val, 0.25)
-                R_75per = np.quantile(R_val, 0.75)
-                T_median = np.median(T_val)
-                T_25per = np.quantile(T_val, 0.25)
-                T_75per = np.quantile(T_val, 0.75)
-
-                # fill median and IQR into the proper bin
-                R_meds[b] = R_median
-                R_75p[b] = R_75per
-                R_25p[b] = R_25per
-                T_meds[b] = T_median
-                T_75p[b] = T_75per
-                T_25p[b] = T_25per
+            R_first, R_factor, T_first, T_factor = binning[p]
+
+            # histograms of individual runs (=showers) in the plotted bins
+            R_hists = rebin(hists[path][p]["R"][1], R_first, R_factor, len(R_bins[p]) - 1)
+            T_hists = rebin(hists[path][p]["kinetic_energy"][1], T_first, T_factor, len(T_bins[p]) - 1)
+
+            # calculate median and interquartile range over runs
+            R_meds = np.median(R_hists, axis=0)
+            R_25p = np.quantile(R_hists, 0.25, axis=0)
+            R_75p = np.quantile(R_hists, 0.75, axis=0)
+            T_meds = np.median(T_hists, axis=0)
+            T_25p = np.quantile(T_hists, 0.25, axis=0)
+            T_75p = np.quantile(T_hists, 0.75, axis=0)
 
             # store histograms in the main arrays
             R_medians[path][p] = R_meds
@@ -454,13 +504,8 @@ def observation():
         ax1.set_axisbelow(True)
         ax2.set_axisbelow(True)
 
-        # get bin centers
-        bin_centers = []
-        for i in range(n_bins):
-            # calculate bin center
-            bin_center = (R_bins[i] + R_bins[i+1]) / 2
-            # append to list
-            bin_centers.append(bin_center)
+        # get bin centers, bins are log-spaced
+        bin_centers = np.sqrt(R_bins[n][:-1] * R_bins[n][1:])
 
         # histogram of reference values and errors (IQR)
         ref_hist = R_medians[ref][n]
@@ -497,6 +542,7 @@ def observation():
                 ax2.fill_between(bin_centers, ratio_errL, ratio_errH, color=(color, alpha_band), edgecolor=(color, alpha_edge), label=None)
 
         # logscale
+        ax1.set_xscale("log")
         ax1.set_yscale("log")
 
         # plot title and axis labels
@@ -544,12 +590,7 @@ def observation():
         ax2.set_axisbelow(True)
 
         # get bin centers
-        bin_centers = []
-        for i in range(n_bins):
-            # calculate bin center
-            bin_center = pow(10,(np.log10(T_bins[i]) + np.log10(T_bins[i+1])) / 2)
-            # append to list
-            bin_centers.append(bin_center)
+        bin_centers = np.sqrt(T_bins[n][:-1] * T_bins[n][1:])
 
         # histogram of reference values and errors (IQR)
         ref_hist = T_medians[ref][n]
@@ -835,19 +876,8 @@ for sim_name in sys.argv[2:]:
 
 print("Found", len(sim_dir), "valid runs, loading data")
 
-# Iterate over output directories and files
+# Outputs are read by each analysis with load(), only runtimes are read here
 for path in sim_dir:
-    # print("  - processing run '", path, "'", sep="")
-
-    for mod, file in output_types.items():
-        # print("   - processing module '", mod, "' (file '", path+mod+"/"+file, ".parquet')", sep="")
-
-        # Compose sim file name
-        sim_file = path + mod + "/" + file + ".parquet"
-
-        # Read from parquet file as dataframe
-        data[path][mod] = pd.read_parquet(sim_file, "pyarrow")
-
     # Runtimes
     data[path]["runtime"] = pd.read_csv(path + "/runtimes.csv", index_col=False)
 
@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+# CPU topology, affinity pinning and tuned concurrency settings of the scheduler
+
+import json
+import os
+import socket
+
+
+# Sysfs locations of the CPU and NUMA topology
+SYS_CPU = "/sys/devices/system/cpu"
+SYS_NODE = "/sys/devices/system/node"
+
+# Pinning modes: no pinning, one run per physical core, runs spread over NUMA nodes
+PINNING = ("none", "core", "numa")
+
+
+# Parse a kernel CPU list such as '0-3,8-11' into a list of CPU ids
+def parse_cpulist(text):
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        lo, _, hi = part.partition("-")
+        cpus += list(range(int(lo), int(hi or lo) + 1))
+    return cpus
+
+
+def read_cpulist(path):
+    try:
+        with open(path, "r") as file:
+            return parse_cpulist(file.read())
+    except (OSError, ValueError):
+        return None
+
+
+# CPUs this process may run on
+def allowed_cpus():
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+# Logical CPUs grouped by physical core, limited to the allowed CPUs
+def physical_cores():
+    allowed = set(allowed_cpus())
+    cores = []
+    seen = set()
+
+    for cpu in sorted(allowed):
+        if cpu in seen:
+            continue
+        siblings = read_cpulist(os.path.join(SYS_CPU, "cpu" + str(cpu), "topology", "thread_siblings_list"))
+        core = sorted(set(siblings or [cpu]) & allowed)
+        seen.update(core)
+        cores.append(core)
+
+    return cores
+
+
+# Logical CPUs grouped by NUMA node, limited to the allowed CPUs
+def numa_nodes():
+    allowed = set(allowed_cpus())
+    nodes = []
+
+    if os.path.isdir(SYS_NODE):
+        for name in sorted(os.listdir(SYS_NODE)):
+            if not name.startswith("node") or not name[4:].isdigit():
+                continue
+            cpus = read_cpulist(os.path.join(SYS_NODE, name, "cpulist"))
+            cpus = sorted(set(cpus or []) & allowed)
+            if cpus:
+                nodes.append(cpus)
+
+    return nodes or [sorted(allowed)]
+
+
+# CPU set of each scheduler slot for a pinning mode, None for no pinning
+def cpusets(mode, threads):
+    if mode == "none":
+        return None
+
+    groups = physical_cores() if mode == "core" else numa_nodes()
+    return [set(groups[i % len(groups)]) for i in range(threads)]
+
+
+# Default concurrency levels to try: half and all physical cores, all logical CPUs and in between
+def default_levels():
+    n_phys = len(physical_cores())
+    n_log = len(allowed_cpus())
+    return sorted({max(n_phys // 2, 1), n_phys, (n_phys + n_log) // 2, n_log})
+
+
+# Tuned settings of all hosts, keyed by host name
+def load_settings(path):
+    if not os.path.isfile(path):
+        return {}
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+# Tuned setting of this host, None if it was not calibrated
+def host_setting(path):
+    return load_settings(path).get(socket.gethostname())
+
+
+def save_setting(path, setting):
+    settings = load_settings(path)
+    settings[socket.gethostname()] = setting
+    with open(path, "w") as file:
+        json.dump(settings, file, indent=2)
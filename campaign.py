@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+# Declarative simulation campaigns: parameter grids, automatic merges and analysis
+
+import asyncio
+import itertools
+import os
+import subprocess
+import sys
+
+
+# Grid parameters, each may be a single value or a list
+GRID_KEYS = ("suffix", "pdg", "energy", "inj", "zenith")
+
+# Per-grid settings falling back to the top level of the campaign file, precision
+# and max_runs are only used with adaptive stopping, total_showers replaces showers
+# and runs by shards of a seed set
+SETTING_KEYS = ("showers", "runs", "walltime", "precision", "max_runs", "total_showers", "seed_set")
+
+
+# Load a campaign file in TOML or YAML format
+def load(path):
+    if path.endswith((".yaml", ".yml")):
+        import yaml
+        with open(path, "r") as file:
+            return yaml.safe_load(file)
+
+    try:
+        import tomllib
+    except ImportError:
+        import tomli as tomllib
+    with open(path, "rb") as file:
+        return tomllib.load(file)
+
+
+# Format a grid value for the simulation name, values given as strings are kept
+# as they are (e.g. "1e4"), integral numbers are written without decimals
+def as_name(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+# Expand all grids of a campaign into a list of configurations (as dictionaries),
+# identical configurations from several grids are kept only once
+def expand(campaign):
+    configs = []
+    seen = set()
+
+    for n, grid in enumerate(campaign.get("grid", [])):
+        missing = [k for k in GRID_KEYS if k not in grid and k not in campaign]
+        if missing:
+            raise ValueError("grid " + str(n) + " misses " + ", ".join(missing))
+
+        axes = []
+        for key in GRID_KEYS:
+            values = grid.get(key, campaign.get(key))
+            axes.append(values if isinstance(values, list) else [values])
+
+        settings = {key: grid.get(key, campaign.get(key)) for key in SETTING_KEYS}
+        if settings["total_showers"] is None and (settings["showers"] is None or settings["runs"] is None):
+            raise ValueError("grid " + str(n) + " needs 'showers' and 'runs' or 'total_showers'")
+
+        for values in itertools.product(*axes):
+            config = {key: as_name(v) for key, v in zip(GRID_KEYS, values)}
+            for key in SETTING_KEYS:
+                config[key] = settings[key]
+            for key in ("showers", "runs", "total_showers"):
+                if config[key] is not None:
+                    config[key] = int(config[key])
+
+            key = tuple(config[k] for k in GRID_KEYS)
+            if key in seen:
+                continue
+            seen.add(key)
+            configs.append(config)
+
+    return configs
+
+
+# Check whether merged outputs are newer than all run summaries
+def merge_is_current(sim_output):
+    merged = os.path.join(sim_output, "merged", "runtimes.csv")
+    if not os.path.isfile(merged):
+        return False
+
+    t_merged = os.path.getmtime(merged)
+    for run in os.listdir(sim_output):
+        summary = os.path.join(sim_output, run, "summary.yaml")
+        if run.startswith("run_") and os.path.isfile(summary) and os.path.getmtime(summary) > t_merged:
+            return False
+    return True
+
+
+# Niceness of ingest and merge processes, they use cores left over by C8
+NICE = 19
+
+
+# Run merge_outputs.py at low priority with the log appended to the merge log
+async def merge_outputs(output_dir, name, *args):
+    with open(os.path.join(output_dir, name, "merge.log"), "a") as log:
+        proc = await asyncio.create_subprocess_exec(sys.executable, "merge_outputs.py", name, *args,
+            stdin=asyncio.subprocess.DEVNULL, stdout=log, stderr=asyncio.subprocess.STDOUT,
+            preexec_fn=lambda: os.nice(NICE))
+        return await proc.wait()
+
+
+# Ingests each run with merge_outputs.py as soon as it finished, and merges a
+# configuration after its last run, registered as a completion hook of the scheduler
+class Merger:
+    def __init__(self, output_dir, parallel=1, ingest=True, options=()):
+        self.output_dir = output_dir
+        self.ingest = ingest
+        # Extra options of merge_outputs.py, e.g. --compact
+        self.options = list(options)
+        # Runs still to finish and runs that failed, per simulation name
+        self.remaining = {}
+        self.failed = {}
+        self.sem = asyncio.Semaphore(parallel)
+        self.merged = []
+
+    # Track a configuration with the given number of pending runs
+    def add(self, config, n_pending):
+        self.remaining[config.name] = n_pending
+        self.failed[config.name] = 0
+
+    # Completion hook of the scheduler
+    async def __call__(self, job, ok):
+        name = job.config.name
+        if name not in self.remaining:
+            return
+
+        # Failed ingests are repeated by the merge
+        if ok and self.ingest:
+            async with self.sem:
+                await merge_outputs(self.output_dir, name, "--ingest", str(job.run))
+
+        self.remaining[name] -= 1
+        if not ok:
+            self.failed[name] += 1
+        if self.remaining[name] == 0:
+            await self.merge(name)
+
+    async def merge(self, name):
+        if self.failed.get(name):
+            print("\033[2K\r  - ", name, ": ", self.failed[name], " failed run(s), not merging", sep="")
+            return
+
+        async with self.sem:
+            print("\033[2K\r  - merging ", name, sep="")
+            code = await merge_outputs(self.output_dir, name, *self.options)
+
+        if code != 0:
+            print("\033[2K\r  - merging ", name, " failed, see ", os.path.join(name, "merge.log"), sep="")
+            return
+        self.merged.append(name)
+
+    # Merge configurations without pending runs whose merged outputs are outdated
+    async def merge_finished(self):
+        for name, n in self.remaining.items():
+            if n == 0 and not merge_is_current(os.path.join(self.output_dir, name)):
+                await self.merge(name)
+
+
+# Run the analysis steps of a campaign after everything was merged
+def run_analysis(campaign):
+    for step in campaign.get("analysis", []):
+        cmd = [sys.executable, "analysis.py", step["plots"]] + list(step["sims"])
+        print("Running analysis '", step["plots"], "'", sep="")
+        subprocess.run(cmd)
@@ -0,0 +1,240 @@
+#!/usr/bin/python3
+# Runtime cost model of C8 runs, fitted to the runtimes of earlier simulations
+
+import csv
+import heapq
+import math
+import os
+import re
+import time
+
+import numpy as np
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+# Simulation name as produced by run.sh, e.g. pdg2212_E1e4_inj112750_z0_opt_expon
+NAME_RE = re.compile(r"^pdg(-?\d+)_E([^_]+)_inj([^_]+)_z([^_]+)_(.*)$")
+
+# Regularisation of the least-squares fit, keeps it stable with few configurations
+RIDGE = 1e-3
+
+# Smallest cos(zenith) used for the slant depth feature
+COS_MIN = 0.05
+
+# Largest fraction of a run spent in C8/FLUKA initialisation when sharding
+OVERHEAD = 0.05
+
+# Runs per thread aimed for when sharding, smaller runs balance the load better
+WAVES = 4
+
+
+# Parse configuration parameters from a simulation name, None if it does not match
+def parse_name(name):
+    match = NAME_RE.match(name)
+    if match is None:
+        return None
+
+    try:
+        return {"pdg": int(match.group(1)),
+                "energy": float(match.group(2)),
+                "inj": float(match.group(3)),
+                "zenith": float(match.group(4)),
+                "suffix": match.group(5)}
+    except ValueError:
+        return None
+
+
+# All fields of a C8 summary file, parsed as YAML so the order of the fields does
+# not matter. Without PyYAML, 'key: value' lines are read as strings.
+def read_summary(path):
+    with open(path, "r") as file:
+        if yaml is None:
+            summary = {}
+            for line in file:
+                key, sep, value = line.partition(":")
+                if sep:
+                    summary[key.strip()] = value.strip()
+            return summary
+
+        try:
+            summary = yaml.safe_load(file)
+        except yaml.YAMLError as error:
+            raise ValueError(path + ": " + str(error)) from error
+    if not isinstance(summary, dict):
+        raise ValueError(path + ": not a YAML mapping")
+    return summary
+
+
+# Collect (configuration, showers, runtime) samples from all simulations in the output directory
+def load_samples(output_dir):
+    samples = []
+
+    if not os.path.isdir(output_dir):
+        return samples
+
+    for sim in sorted(os.listdir(output_dir)):
+        sim_path = os.path.join(output_dir, sim)
+        params = parse_name(sim)
+        if params is None or not os.path.isdir(sim_path):
+            continue
+
+        found = []
+
+        # Prefer summaries of the individual runs
+        for run in os.listdir(sim_path):
+            path = os.path.join(sim_path, run, "summary.yaml")
+            if not run.startswith("run_") or not os.path.isfile(path):
+                continue
+            # Empty or truncated summaries of killed runs are skipped
+            try:
+                summary = read_summary(path)
+                found.append((int(summary["showers"]), float(summary["runtime"])))
+            except (OSError, KeyError, TypeError, ValueError):
+                continue
+
+        # Otherwise use runtimes kept by merge_outputs.py
+        path = os.path.join(sim_path, "merged", "runtimes.csv")
+        if not found and os.path.isfile(path):
+            with open(path, "r") as file:
+                for row in csv.DictReader(file):
+                    try:
+                        found.append((int(row["showers"]), float(row["runtime"])))
+                    except (KeyError, ValueError, TypeError):
+                        continue
+
+        for showers, runtime in found:
+            if showers > 0 and runtime > 0:
+                samples.append((params, showers, runtime))
+
+    return samples
+
+
+# Initialisation time of a run, from simulations with runs of different shower
+# counts: median intercept of runtime = init + showers * per_shower, None if unknown
+def estimate_init(samples):
+    groups = {}
+    for params, showers, runtime in samples:
+        key = tuple(sorted(params.items()))
+        groups.setdefault(key, []).append((showers, runtime))
+
+    intercepts = []
+    for points in groups.values():
+        if len({showers for showers, _ in points}) < 2:
+            continue
+        n, t = np.array(points, dtype=float).T
+        slope, intercept = np.polyfit(n, t, 1)
+        if slope > 0 and intercept > 0:
+            intercepts.append(intercept)
+
+    return float(np.median(intercepts)) if intercepts else None
+
+
+# Log-linear regression of the runtime per shower over energy, slant depth,
+# injection height and a per-PDG offset, plus a fixed initialisation time if known
+class CostModel:
+    def __init__(self, samples):
+        self.n_samples = len(samples)
+        self.pdgs = sorted({params["pdg"] for params, _, _ in samples})
+        self.coef = None
+        self.init = estimate_init(samples)
+
+        if not samples:
+            return
+
+        init = self.init or 0.0
+        x = np.array([self.features(params["pdg"], params["energy"], params["inj"], params["zenith"])
+            for params, _, _ in samples])
+        y = np.array([math.log(max(runtime - init, 0.1 * runtime) / showers) for _, showers, runtime in samples])
+
+        # Ridge regression, the intercept is not regularised
+        reg = RIDGE * np.eye(x.shape[1])
+        reg[0, 0] = 0
+        self.coef = np.linalg.solve(x.T @ x + reg, x.T @ y)
+
+    @classmethod
+    def from_output(cls, output_dir):
+        return cls(load_samples(output_dir))
+
+    # Model has data to predict from
+    @property
+    def ready(self):
+        return self.coef is not None
+
+    def features(self, pdg, energy, inj, zenith):
+        cos_z = max(math.cos(math.radians(zenith)), COS_MIN)
+        row = [1.0, math.log(energy), math.log(1 / cos_z), math.log(max(inj, 1.0))]
+        row += [1.0 if pdg == p else 0.0 for p in self.pdgs]
+        return row
+
+    # Predicted runtime of one shower of a configuration, without initialisation (in s)
+    def per_shower(self, config):
+        x = np.array(self.features(int(config.pdg), float(config.energy), float(config.inj), float(config.zenith)))
+        return math.exp(x @ self.coef)
+
+    # Predicted runtime of one run of a configuration (in s)
+    def predict(self, config):
+        return (self.init or 0.0) + config.showers * self.per_shower(config)
+
+
+# Showers per run when splitting a total number of showers: small enough for
+# WAVES runs per thread, but large enough that initialisation takes at most
+# OVERHEAD of a run
+def shard_size(model, config, total, threads):
+    showers = math.ceil(total / (max(threads, 1) * WAVES))
+
+    if model.ready and model.init:
+        per_shower = model.per_shower(config)
+        showers = max(showers, math.ceil(model.init * (1 - OVERHEAD) / (OVERHEAD * per_shower)))
+
+    return max(min(showers, total), 1)
+
+
+# Order jobs by predicted runtime, longest first
+def longest_first(jobs, model):
+    if not model.ready:
+        return list(jobs)
+    return sorted(jobs, key=lambda job: model.predict(job.config), reverse=True)
+
+
+# Wall time of running the jobs in the given order with a fixed number of threads
+def makespan(durations, threads):
+    cores = [0.0] * max(threads, 1)
+    for d in durations:
+        heapq.heappush(cores, heapq.heappop(cores) + d)
+    return max(cores)
+
+
+# Format seconds as e.g. 2h 05m 13s
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    h, rest = divmod(seconds, 3600)
+    m, s = divmod(rest, 60)
+    if h:
+        return "{}h {:02d}m {:02d}s".format(h, m, s)
+    if m:
+        return "{}m {:02d}s".format(m, s)
+    return "{}s".format(s)
+
+
+# Print predicted CPU time, wall time and ETA of a list of jobs
+def print_forecast(jobs, model, threads):
+    if not jobs:
+        return
+
+    if not model.ready:
+        print("No earlier runtimes found, no runtime forecast")
+        return
+
+    durations = [model.predict(job.config) for job in jobs]
+    wall = makespan(durations, threads)
+    eta = time.strftime("%Y-%m-%d %H:%M", time.localtime(time.time() + wall))
+
+    print("Runtime forecast (from", model.n_samples, "earlier runs):")
+    print(" - CPU time  : ", format_duration(sum(durations)))
+    print(" - Longest   : ", format_duration(max(durations)))
+    print(" - Wall time : ", format_duration(wall), "on", threads, "threads")
+    print(" - ETA       : ", eta)
@@ -0,0 +1,410 @@
+#!/usr/bin/python3
+# Batch system executors of scheduler.py: runs are submitted as array jobs (one
+# task per run_N), tracked in the ledger and checked for complete outputs
+
+import asyncio
+import os
+import random
+
+import ledger as lg
+import metrics
+
+
+# Directory with the scheduler, array tasks change into it before running
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# Run a command and return its standard output, raises on failure or after
+# timeout seconds (None for no limit)
+async def check_output(*cmd, timeout=None):
+    proc = await asyncio.create_subprocess_exec(*cmd, stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    try:
+        out, err = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise RuntimeError(" ".join(cmd[:1]) + " timed out after " + str(timeout) + " s")
+    if proc.returncode != 0:
+        raise RuntimeError(" ".join(cmd[:1]) + " failed: " + err.decode().strip())
+    return out.decode()
+
+
+# Common part of all batch executors: task scripts, submission of one array per
+# configuration, polling of task states, retries and collection of outputs
+class BatchExecutor:
+    name = None
+    # Seconds between state queries, the longest a query may take and the number
+    # of failed queries in a row after which the tasks of an array count as lost
+    poll_interval = 30
+    poll_timeout = 120
+    poll_retries = 10
+
+    def __init__(self, ledger, env_script, retries=0, threads=None, task_args=(), options=()):
+        self.ledger = ledger
+        # Script entering the C8 environment on the worker node
+        self.env_script = env_script
+        self.retries = retries
+        # Maximum number of concurrently running tasks, None for no limit
+        self.threads = threads
+        # Extra options of 'scheduler.py exec' (scratch, telemetry, wall time)
+        self.task_args = list(task_args)
+        # Extra batch system options, one per line of the submission
+        self.options = list(options)
+        # Per-configuration wall-time budgets, passed to the array tasks
+        self.budgets = {}
+        # Coroutines called with (job, ok) whenever a run is finished
+        self.hooks = []
+        # Metrics file updated while running, None for no metrics
+        self.metrics_file = None
+        self.attempts = {}
+        # Submitted arrays as {batch id: {run: job}}, created by run_async
+        self.active = {}
+        # Failed state queries in a row of each array
+        self.poll_errors = {}
+        self.n_failed = 0
+        self.n_total = 0
+
+    # Directory with submission files of a simulation
+    def batch_dir(self, job):
+        path = os.path.join(job.sim_output, "batch")
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    # Batch output file of a task, the run log itself is written by 'scheduler.py exec'
+    def task_output(self, job, index="{run}"):
+        return job.sim_output + "_batch_" + index + ".out"
+
+    # Shell script running one run of a configuration, the run index is the first argument
+    def write_task_script(self, job, header=()):
+        c = job.config
+        path = os.path.join(self.batch_dir(job), "task.sh")
+
+        with open(path, "w") as file:
+            file.write("#!/bin/bash\n")
+            for line in header:
+                file.write(line + "\n")
+            file.write("# Array task running one C8 run of " + c.name + "\n")
+            file.write("RUN=${1:-${SLURM_ARRAY_TASK_ID}}\n")
+            # Seeds of all runs of the configuration known to the ledger
+            seeds = ["[{}]={}".format(row["run"], row["seed"]) for row in self.ledger.rows(sim=c.name)]
+            file.write("SEEDS=(" + " ".join(seeds) + ")\n")
+            file.write("cd " + REPO_DIR + "\n")
+            file.write("source " + self.env_script + "\n")
+            cmd = ["python3", "scheduler.py", "exec", c.suffix, c.pdg, c.energy, c.inj, c.zenith,
+                str(c.showers), str(c.runs), "$RUN", "--seed", "${SEEDS[$RUN]}"] + self.task_args
+            if c.name in self.budgets:
+                cmd += ["--walltime", str(self.budgets[c.name])]
+            file.write("exec " + " ".join(cmd) + "\n")
+
+        os.chmod(path, 0o755)
+        return path
+
+    # Submit runs of one configuration, return the batch id
+    async def submit(self, jobs):
+        raise NotImplementedError
+
+    # States of the tasks of a submission as {run: (state, exit code, host)}, runs
+    # unknown to the batch system yet are left out
+    async def poll(self, batch_id, jobs):
+        raise NotImplementedError
+
+    # Gather the batch output of a finished task and decide on its outcome, message
+    # tells why a task failed if not from its exit code
+    def collect(self, job, code, message=None):
+        out = self.task_output(job).format(run=job.run)
+        if os.path.isfile(out) and os.path.isdir(job.run_output):
+            os.replace(out, os.path.join(job.run_output, "batch.out"))
+
+        if code == 0 and job.complete:
+            self.ledger.finish(job, lg.DONE, code)
+            return True
+
+        if message is None:
+            message = "exit code {}".format(code) if code != 0 else "no summary.yaml written"
+        self.ledger.finish(job, lg.FAILED, code, message)
+        print("  - ", job.label, ": ", message, sep="")
+        return False
+
+    async def submit_all(self, jobs, active):
+        # One array per configuration
+        groups = {}
+        for job in jobs:
+            groups.setdefault(job.config, []).append(job)
+
+        for group in groups.values():
+            batch_id = await self.submit(group)
+            print("Submitted ", len(group), " run(s) of ", group[0].config.name, " as ", self.name, " job ", batch_id, sep="")
+            for job in group:
+                self.ledger.note(job, self.name + " " + str(batch_id))
+            active[batch_id] = {job.run: job for job in group}
+
+    # Hooks of a run are called in order, e.g. adaptive stopping before merging
+    async def call_hooks(self, job, ok):
+        for hook in self.hooks:
+            await hook(job, ok)
+
+    # Add jobs to a running executor, e.g. from a completion hook
+    async def add_jobs(self, jobs):
+        self.n_total += len(jobs)
+        await self.submit_all(jobs, self.active)
+
+    async def run_async(self, jobs):
+        if not jobs:
+            return 0
+
+        active = self.active = {}
+        hooks = []
+        self.n_total = len(jobs)
+        n_done = 0
+        await self.submit_all(jobs, active)
+        status = None
+        exporter = None
+        if self.metrics_file is not None:
+            exporter = asyncio.create_task(metrics.export(self.ledger, self.metrics_file, self.threads))
+
+        # Hooks may still submit further runs
+        while active or not all(task.done() for task in hooks):
+            await asyncio.sleep(self.poll_interval)
+            retry = []
+
+            for batch_id, tasks in list(active.items()):
+                # A batch system that is busy or restarting is asked again at the next poll
+                lost = None
+                try:
+                    states = await self.poll(batch_id, list(tasks.values()))
+                    self.poll_errors.pop(batch_id, None)
+                except (RuntimeError, OSError) as err:
+                    n_errors = self.poll_errors[batch_id] = self.poll_errors.get(batch_id, 0) + 1
+                    print("  - polling ", self.name, " job ", batch_id, " failed (", n_errors, "/", self.poll_retries,
+                        "): ", err, sep="")
+                    if n_errors < self.poll_retries:
+                        continue
+                    del self.poll_errors[batch_id]
+                    lost = "lost after {} failed polls of {} job {}".format(n_errors, self.name, batch_id)
+                    states = {run: (lg.FAILED, None, None) for run in tasks}
+
+                for run, (state, code, host) in states.items():
+                    job = tasks.get(run)
+                    if job is None:
+                        continue
+
+                    row = self.ledger.get(job)
+                    if state == lg.RUNNING and row["state"] == lg.QUEUED:
+                        self.ledger.start(job, None, host)
+                    if state not in (lg.DONE, lg.FAILED):
+                        continue
+
+                    del tasks[run]
+                    if row["state"] == lg.QUEUED:
+                        self.ledger.start(job, None, host)
+
+                    ok = self.collect(job, code if state == lg.DONE else (code or 1), lost)
+                    self.attempts[job] = self.attempts.get(job, 0) + 1
+                    if not ok and self.attempts[job] <= self.retries:
+                        print("  - ", job.label, ": retrying", sep="")
+                        self.ledger.queue(job)
+                        retry.append(job)
+                        continue
+
+                    n_done += 1
+                    if not ok:
+                        self.n_failed += 1
+                    hooks.append(asyncio.create_task(self.call_hooks(job, ok)))
+
+                if not tasks:
+                    del active[batch_id]
+
+            if status != (n_done, self.n_total, self.n_failed, len(active)):
+                status = (n_done, self.n_total, self.n_failed, len(active))
+                print("Finished {}/{} run(s), {} failed, {} array(s) active".format(*status))
+
+            if retry:
+                await self.submit_all(retry, active)
+
+        await asyncio.gather(*hooks)
+        if exporter is not None:
+            exporter.cancel()
+            await asyncio.gather(exporter, return_exceptions=True)
+
+        return self.n_failed
+
+    def run(self, jobs):
+        return asyncio.run(self.run_async(jobs))
+
+
+# Slurm: sbatch array jobs, states from sacct
+class SlurmExecutor(BatchExecutor):
+    name = "slurm"
+
+    # Slurm states counted as finished without success
+    FAILED = ("FAILED", "CANCELLED", "TIMEOUT", "NODE_FAIL", "OUT_OF_MEMORY", "PREEMPTED", "BOOT_FAIL", "DEADLINE")
+
+    async def submit(self, jobs):
+        job = jobs[0]
+        header = ["#SBATCH --job-name=" + job.config.name,
+                  "#SBATCH --output=" + self.task_output(job, "%a"),
+                  "#SBATCH --ntasks=1",
+                  "#SBATCH --cpus-per-task=1"]
+        header += ["#SBATCH " + opt for opt in self.options]
+        script = self.write_task_script(job, header)
+
+        array = ",".join(str(j.run) for j in jobs)
+        if self.threads:
+            array += "%" + str(self.threads)
+
+        out = await check_output("sbatch", "--parsable", "--array=" + array, script)
+        return out.strip().split(";")[0]
+
+    async def poll(self, batch_id, jobs):
+        out = await check_output("sacct", "-j", batch_id, "--noheader", "--parsable2", "--allocations",
+            "--format=JobID,State,ExitCode,NodeList", timeout=self.poll_timeout)
+
+        states = {}
+        for line in out.splitlines():
+            job_id, state, code, node = line.split("|")
+            _, _, task = job_id.partition("_")
+            if not task.isdigit():
+                continue
+
+            state = state.split()[0]
+            code = int(code.split(":")[0])
+            if state == "PENDING":
+                states[int(task)] = (lg.QUEUED, None, None)
+            elif state == "COMPLETED":
+                states[int(task)] = (lg.DONE, code, node)
+            elif state in self.FAILED:
+                states[int(task)] = (lg.FAILED, code, node)
+            else:
+                states[int(task)] = (lg.RUNNING, None, node)
+
+        return states
+
+
+# HTCondor: one cluster per submission, states from condor_q and condor_history
+class CondorExecutor(BatchExecutor):
+    name = "condor"
+
+    # JobStatus values
+    IDLE, RUNNING, REMOVED, COMPLETED, HELD = 1, 2, 3, 4, 5
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Runs of each cluster by ProcId, the jobs passed to poll shrink as tasks finish
+        self.procs = {}
+
+    async def submit(self, jobs):
+        job = jobs[0]
+        script = self.write_task_script(job)
+        path = os.path.join(self.batch_dir(job), "task.sub")
+
+        with open(path, "w") as file:
+            file.write("executable = " + script + "\n")
+            file.write("arguments = $(run)\n")
+            file.write("output = " + self.task_output(job, "$(run)") + "\n")
+            file.write("error = " + self.task_output(job, "$(run)") + ".err\n")
+            file.write("log = " + os.path.join(self.batch_dir(job), "condor.log") + "\n")
+            file.write("request_cpus = 1\n")
+            file.write("getenv = True\n")
+            # Jobs of the cluster that exist at a time, idle or running (max_idle
+            # would only limit the idle ones)
+            if self.threads:
+                file.write("max_materialize = " + str(self.threads) + "\n")
+            for opt in self.options:
+                file.write(opt + "\n")
+            file.write("queue run in (" + " ".join(str(j.run) for j in jobs) + ")\n")
+
+        out = await check_output("condor_submit", "-terse", path)
+        batch_id = out.split(".")[0].strip()
+        # Process ids follow the order of the queue statement
+        self.procs[batch_id] = [j.run for j in jobs]
+        return batch_id
+
+    async def poll(self, batch_id, jobs):
+        order = self.procs[batch_id]
+        states = {}
+
+        # Finished jobs last, so their final state wins
+        out = await check_output("condor_q", batch_id, "-af", "ProcId", "JobStatus", "ExitCode", "RemoteHost",
+            timeout=self.poll_timeout)
+        out += await check_output("condor_history", batch_id, "-af", "ProcId", "JobStatus", "ExitCode", "LastRemoteHost",
+            timeout=self.poll_timeout)
+
+        for line in out.splitlines():
+            fields = line.split()
+            if len(fields) < 2 or not fields[0].isdigit():
+                continue
+            proc, status = int(fields[0]), int(fields[1])
+            if proc >= len(order):
+                continue
+            run = order[proc]
+            code = int(fields[2]) if len(fields) > 2 and fields[2].lstrip("-").isdigit() else None
+            host = fields[3] if len(fields) > 3 and fields[3] != "undefined" else None
+
+            if status == self.COMPLETED:
+                states[run] = (lg.DONE, code, host)
+            elif status in (self.REMOVED, self.HELD):
+                states[run] = (lg.FAILED, code, host)
+            elif status == self.RUNNING:
+                states[run] = (lg.RUNNING, None, host)
+            else:
+                states[run] = (lg.QUEUED, None, None)
+
+        return states
+
+
+# Local stand-in for a batch system: tasks wait a random queueing delay and then
+# run as subprocesses on a fixed number of fake nodes, using the same task
+# scripts as the real backends
+class FakeBatchExecutor(BatchExecutor):
+    name = "fake"
+    poll_interval = 1
+
+    # Number of fake nodes and maximum queueing delay (in s)
+    NODES = 2
+    MAX_DELAY = 2.0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.nodes = asyncio.Queue()
+        self.states = {}
+        self.tasks = set()
+        self.n_submitted = 0
+
+    async def task(self, batch_id, job, script):
+        await asyncio.sleep(random.uniform(0, self.MAX_DELAY))
+
+        node = await self.nodes.get()
+        try:
+            self.states[batch_id][job.run] = (lg.RUNNING, None, node)
+            with open(self.task_output(job).format(run=job.run), "w") as out:
+                proc = await asyncio.create_subprocess_exec("bash", script, str(job.run),
+                    stdin=asyncio.subprocess.DEVNULL, stdout=out, stderr=asyncio.subprocess.STDOUT)
+                code = await proc.wait()
+            self.states[batch_id][job.run] = (lg.DONE if code == 0 else lg.FAILED, code, node)
+        finally:
+            self.nodes.put_nowait(node)
+
+    async def submit(self, jobs):
+        if self.nodes.empty() and not self.n_submitted:
+            for n in range(self.threads or self.NODES):
+                self.nodes.put_nowait("fake-node-" + str(n))
+
+        self.n_submitted += 1
+        batch_id = str(self.n_submitted)
+        script = self.write_task_script(jobs[0])
+        self.states[batch_id] = {job.run: (lg.QUEUED, None, None) for job in jobs}
+
+        for job in jobs:
+            t = asyncio.create_task(self.task(batch_id, job, script))
+            self.tasks.add(t)
+            t.add_done_callback(self.tasks.discard)
+
+        return batch_id
+
+    async def poll(self, batch_id, jobs):
+        return dict(self.states[batch_id])
+
+
+# Available batch executors, the local scheduler is the default
+EXECUTORS = {"slurm": SlurmExecutor, "condor": CondorExecutor, "fake": FakeBatchExecutor}
@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+# SQLite ledger holding the state of every (simulation, run) pair
+
+import os
+import socket
+import sqlite3
+import time
+
+
+# States of a run
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# One row per run, configuration columns allow resuming without the original call
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    sim TEXT NOT NULL,
+    run INTEGER NOT NULL,
+    suffix TEXT NOT NULL,
+    pdg TEXT NOT NULL,
+    energy TEXT NOT NULL,
+    inj TEXT NOT NULL,
+    zenith TEXT NOT NULL,
+    showers INTEGER NOT NULL,
+    runs INTEGER NOT NULL,
+    seed INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    exit_code INTEGER,
+    start_time REAL,
+    end_time REAL,
+    host TEXT,
+    pid INTEGER,
+    message TEXT,
+    PRIMARY KEY (sim, run)
+)
+"""
+
+
+# Check whether a process with the given PID exists on this host
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Ledger:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.host = socket.gethostname()
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    # Ledger row of a run, None if the run is not known
+    def get(self, job):
+        return self.conn.execute("SELECT * FROM jobs WHERE sim = ? AND run = ?",
+            (job.config.name, job.run)).fetchone()
+
+    # Add a run in the queued state, or move a known run back to the queue
+    def queue(self, job):
+        c = job.config
+        self.conn.execute("""
+            INSERT INTO jobs (sim, run, suffix, pdg, energy, inj, zenith, showers, runs, seed, state)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (sim, run) DO UPDATE SET
+                state = excluded.state, seed = excluded.seed, showers = excluded.showers,
+                runs = excluded.runs, exit_code = NULL, pid = NULL, message = NULL""",
+            (c.name, job.run, c.suffix, c.pdg, c.energy, c.inj, c.zenith, c.showers, c.runs, job.seed, QUEUED))
+
+    # Mark a run as running, host defaults to this host
+    def start(self, job, pid, host=None):
+        self.conn.execute("""
+            UPDATE jobs SET state = ?, attempts = attempts + 1, start_time = ?, end_time = NULL,
+                host = ?, pid = ?, exit_code = NULL
+            WHERE sim = ? AND run = ?""",
+            (RUNNING, time.time(), host or self.host, pid, job.config.name, job.run))
+
+    # Attach a note to a run, e.g. the batch job id of a queued run
+    def note(self, job, message):
+        self.conn.execute("UPDATE jobs SET message = ? WHERE sim = ? AND run = ?",
+            (message, job.config.name, job.run))
+
+    def finish(self, job, state, code, message=None):
+        self.conn.execute("""
+            UPDATE jobs SET state = ?, exit_code = ?, end_time = ?, pid = NULL, message = ?
+            WHERE sim = ? AND run = ?""",
+            (state, code, time.time(), message, job.config.name, job.run))
+
+    # Record a run that finished outside of the ledger (e.g. by the old run.sh)
+    def mark_done(self, job):
+        self.queue(job)
+        self.finish(job, DONE, 0, "found existing output")
+
+    # Check whether a run marked as running is still alive, only decidable on its own host
+    def is_stale(self, row):
+        if row["state"] != RUNNING:
+            return False
+        if row["host"] != self.host:
+            return False
+        return row["pid"] is None or not pid_alive(row["pid"])
+
+    # Rows in the given states, ordered by simulation and run
+    def rows(self, states=None, sim=None):
+        query = "SELECT * FROM jobs"
+        cond = []
+        params = []
+        if states:
+            cond.append("state IN (" + ",".join("?" * len(states)) + ")")
+            params += list(states)
+        if sim:
+            cond.append("sim = ?")
+            params.append(sim)
+        if cond:
+            query += " WHERE " + " AND ".join(cond)
+        return self.conn.execute(query + " ORDER BY sim, run", params).fetchall()
@@ -1,19 +1,32 @@
 #!/usr/bin/python3
-# Script to merge parquet output files from multiple Corsika8 runs
+# Script to merge parquet output files from multiple Corsika8 runs. Runs can be
+# ingested one by one as soon as they finish (--ingest), the merge then only
+# joins the ingested parts. Several simulations can be merged at once, with runs
+# and output types processed in parallel (--jobs). Merged outputs are extended
+# incrementally: runs already merged are kept, new runs are appended as segments.
+# Optionally, the outputs are also written as a dataset partitioned by run and
+# particle family (--dataset). Merged files are sorted by shower (and X) with row
+# groups of whole showers, an index gives the rows of each shower. Longitudinal
+# outputs get a summary of each column per X, particles on the observation plane
+# per-shower histograms of R and kinetic energy.
 
-import pandas as pd
+import argparse
+import glob
+import json
 import os
-import sys
-
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 
-# Directory with simulation outputs
-sim_name = sys.argv[1]
-output_dir = "output/" + sim_name
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 
-# Make a directory for merged outputs
-os.makedirs(output_dir + "/merged", exist_ok=True)
+import costmodel as cm
+import runtimes as rt
 
-print ("Simulation output: '", output_dir, "'", sep="")
 
 # Map directories and output files inside
 output_types = {"energyloss": "dEdX",
@@ -22,70 +35,965 @@ output_types = {"energyloss": "dEdX",
                 "production_profile": "profile",
                 "profile": "profile"}
 
-# Declare dictionaries to hold dataframes
-data = {}
-for dir in output_types.keys():
-    data[dir] = {}
+# Directory inside merged/ with the ingested outputs of each run. Parts of the
+# outputs are removed once merged, the histograms of each run are kept.
+PARTS = ".parts"
 
-# Current shower id, used for shifting shower indices
-id_shw = 0
+# Runs merged so far with their sizes, modification times and shower offsets,
+# and the segments of the merged files
+MANIFEST = "manifest.json"
 
-# List of subdirectories
-dir_list = os.listdir(output_dir)
+# Merged files are rebuilt into one segment once they have more segments
+MAX_SEGMENTS = 16
 
-# Filter only run directories
-n_fake = 0
-for dir in dir_list:
-    if "run" not in dir:
-        n_fake += 1
+# Directory inside merged/ with the partitioned dataset of each output
+DATASET = "dataset"
 
-# Number of run subdirectories
-n_dirs = len(dir_list) - n_fake
+# Particle families of the partitions of the particles dataset by |pdg|, other
+# particles are hadrons (and nuclei) from 100 on and 'other' below
+FAMILIES = {11: "ep", 13: "muon", 22: "photon"}
 
-# Create a file with runtimes
-runtime_file = open(output_dir + "/merged/runtimes.csv", "w")
-# Write header
-runtime_file.write("run,showers,runtime\n")
+# Longitudinal outputs summarised per X, with the sums of columns analysed together
+SUMMARY_SUMS = {"energyloss": {},
+                "production_profile": {},
+                "profile": {"ep": ("electron", "positron"), "muon": ("muplus", "muminus")}}
 
-# Iterate over runs in this simulation
-for run in range(n_dirs):
-    print("Processing run", run)
+# Per-shower histograms of particles by family, from a part of each run
+HISTOGRAMS = "histograms"
 
-    # Open summary file to read number of showers
-    with open(output_dir + "/run_" + str(run) + "/summary.yaml", "r") as file:
-        content = file.readlines()
-        n_shw = int(content[0].split()[1])
-        runtime = float(content[5].split()[1])
-        print("  - showers = ", n_shw, "runtime = ", runtime)
-        runtime_file.write(",".join([str(run),str(n_shw),str(runtime),"\n"]))
+# Fixed log-spaced axes of the histograms, R in m and kinetic energy in GeV, with
+# an underflow and an overflow bin. Histograms of runs and showers add up.
+HIST_EDGES = {"R": np.logspace(-2, 5, 141), "kinetic_energy": np.logspace(-6, 12, 361)}
+HIST_FAMILIES = list(FAMILIES.values()) + ["hadron", "other"]
+
+# Rows read and written at once, the memory use of a merge stays around one batch
+# (or one row group of the C8 output) independent of the number of runs
+BATCH_ROWS = 1 << 16
+
+# Parquet settings of the merged outputs and the dataset: codec and its level
+# (None for the default of the codec), rows per row group, dictionary encoding and
+# the columns with row group statistics ("all" or only "shower")
+CODECS = ("snappy", "zstd", "lz4", "gzip", "none")
+DEFAULT_FORMAT = {"codec": "snappy", "level": None, "row_group_rows": BATCH_ROWS, "dictionary": True, "statistics": "all"}
+
+
+# Indices of the run directories of a simulation in ascending order. Runs may be
+# missing, e.g. removed after a failure, and other entries (merged/, leftover
+# staging directories) are no runs.
+def run_indices(output_dir):
+    return sorted(int(name[4:]) for name in os.listdir(output_dir) if name.startswith("run_") and name[4:].isdigit()
+        and os.path.isdir(os.path.join(output_dir, name)))
+
+
+# Number of showers and runtime of a run from its summary file
+def read_summary(output_dir, run):
+    summary = cm.read_summary(output_dir + "/run_" + str(run) + "/summary.yaml")
+    return int(summary["showers"]), float(summary["runtime"])
+
+
+# Ingested output of a run
+def part_file(output_dir, dir, run):
+    return output_dir + "/merged/" + PARTS + "/" + dir + "/run_" + str(run) + ".parquet"
+
+
+# Merged file of an output, the first segment keeps the name of a complete merge
+# and appended segments sort after it
+def segment_file(output_dir, dir, segment):
+    base = output_dir + "/merged/" + dir + "/" + output_types[dir]
+    if segment == 0:
+        return base + ".parquet"
+    return base + "_{:04d}.parquet".format(segment)
+
+
+# Index of the showers in a merged file: first and last row group and the range
+# of rows (end exclusive) of each shower
+def index_file(merged_file):
+    return merged_file[:-len(".parquet")] + ".index.parquet"
+
+
+# Summary and output files of a run
+def run_files(output_dir, run):
+    run_dir = output_dir + "/run_" + str(run)
+    return [run_dir + "/summary.yaml"] + [run_dir + "/" + dir + "/" + file + ".parquet" for dir, file in output_types.items()]
+
+
+# Check whether a run wrote its summary and all outputs
+def is_complete(output_dir, run):
+    return all(os.path.isfile(f) for f in run_files(output_dir, run))
+
+
+# Size and latest modification time of a run, a run that changes after it was
+# merged (e.g. simulated again) is merged again
+def run_signature(output_dir, run):
+    stats = [os.stat(f) for f in run_files(output_dir, run)]
+    return {"size": sum(st.st_size for st in stats), "mtime": max(st.st_mtime_ns for st in stats)}
+
+
+def read_manifest(output_dir):
+    path = output_dir + "/merged/" + MANIFEST
+    if not os.path.isfile(path):
+        return {"runs": [], "segments": []}
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def write_manifest(output_dir, manifest):
+    path = output_dir + "/merged/" + MANIFEST
+    with open(path + ".tmp", "w") as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+# Check whether the outputs of a run (all of them by default) were ingested after
+# the run finished
+def is_ingested(output_dir, run, dirs=None):
+    t_run = max(os.path.getmtime(f) for f in run_files(output_dir, run))
+    for dir in dirs or list(output_types) + [HISTOGRAMS]:
+        part = part_file(output_dir, dir, run)
+        if not os.path.isfile(part) or os.path.getmtime(part) < t_run:
+            return False
+    return True
+
+
+# Keyword arguments of the parquet writers for a format
+def parquet_options(format, compact=False):
+    dictionary = format["dictionary"] or (COMPACT_DICTIONARY if compact else False)
+    return {"compression": format["codec"], "compression_level": format["level"], "use_dictionary": dictionary,
+            "write_statistics": True if format["statistics"] == "all" else ["shower"]}
+
+
+# Add a constant to the shower indices of a table
+def shift_showers(table, shift):
+    if not shift:
+        return table
+    index = table.schema.get_field_index("shower")
+    return table.set_column(index, "shower", pc.add(table["shower"], pa.scalar(shift, table["shower"].type)))
+
+
+# Convert one output of a run into a part of the merged output. Shower indices
+# are shifted assuming all runs have as many showers as this one, the offset is
+# kept in the part and corrected when joining if runs differ in size.
+def ingest_output(output_dir, run, dir):
+    n_shw, _ = read_summary(output_dir, run)
+    offset = run * n_shw
+
+    # Compose output file name
+    output_file = output_dir + "/run_" + str(run) + "/" + dir + "/" + output_types[dir] + ".parquet"
+    part = part_file(output_dir, dir, run)
+    os.makedirs(os.path.dirname(part), exist_ok=True)
+
+    # Histograms of particles are filled while ingesting
+    hists = Histograms(n_shw) if dir == "particles" else None
+
+    with pq.ParquetFile(output_file) as source:
+        schema = source.schema_arrow.with_metadata({"shower_offset": str(offset)})
+        keys = sort_keys(schema)
+
+        # Stream record batches, shifting shower indices, as long as they are in order
+        if not write_sorted(source, part + ".tmp", schema, keys, offset, hists):
+            # Otherwise sort the whole run in memory
+            table = source.read().sort_by([(key, "ascending") for key in keys])
+            if hists is not None:
+                hists = Histograms(n_shw)
+                hists.add(table)
+            table = shift_showers(table, offset)
+            metadata = dict(schema.metadata, **{MISFITS: ",".join(sorted(compact_misfits(table)))})
+            pq.write_table(table.replace_schema_metadata(metadata), part + ".tmp", row_group_size=BATCH_ROWS)
+
+    os.replace(part + ".tmp", part)
+    if hists is not None:
+        hists.write(part_file(output_dir, HISTOGRAMS, run), offset)
+
+
+# Histograms of R and kinetic energy of the particles of each shower and family of a run
+class Histograms:
+    def __init__(self, n_showers):
+        self.counts = {axis: np.zeros((n_showers, len(HIST_FAMILIES), len(edges) + 1), np.int64)
+            for axis, edges in HIST_EDGES.items()}
+
+    # Fill the particles of a table, showers numbered from 0 in the run
+    def add(self, table):
+        if not table.num_rows:
+            return
+        shower = table["shower"].to_numpy()
+        family = pc.index_in(particle_family(table["pdg"]), pa.array(HIST_FAMILIES)).to_numpy()
+        values = {"R": np.hypot(table["x"].to_numpy(), table["y"].to_numpy()),
+                  "kinetic_energy": table["kinetic_energy"].to_numpy()}
+
+        for axis, edges in HIST_EDGES.items():
+            counts = self.counts[axis]
+            if shower.max() >= counts.shape[0]:
+                counts = np.concatenate([counts, np.zeros((shower.max() + 1 - counts.shape[0],) + counts.shape[1:], np.int64)])
+                self.counts[axis] = counts
+
+            # Flat index of shower, family and bin, showers of a table are close to each other
+            bins = np.searchsorted(edges, values[axis], side="right")
+            key = (shower * len(HIST_FAMILIES) + family) * counts.shape[2] + bins
+            first = key.min()
+            filled = np.bincount(key - first)
+            counts.reshape(-1)[first:first + len(filled)] += filled
+
+    # Write the histograms as one row per shower and family, with the edges of the axes
+    def write(self, path, offset):
+        n_showers = len(self.counts["R"])
+        columns = {"shower": pa.array(np.repeat(np.arange(n_showers) + offset, len(HIST_FAMILIES))),
+                   "family": pa.array(HIST_FAMILIES * n_showers)}
+        for axis, counts in self.counts.items():
+            columns[axis] = pa.FixedSizeListArray.from_arrays(pa.array(counts.reshape(-1), pa.int32()), counts.shape[2])
+
+        metadata = {axis + "_edges": json.dumps(edges.tolist()) for axis, edges in HIST_EDGES.items()}
+        metadata["shower_offset"] = str(offset)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pq.write_table(pa.table(columns).replace_schema_metadata(metadata), path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+
+# Columns the outputs are sorted by
+def sort_keys(schema):
+    return [key for key in ("shower", "X") if key in schema.names]
+
+
+# Check whether the rows of a table follow each other and the last row before it
+def in_order(table, keys, last):
+    columns = [table[key].to_numpy() for key in keys]
+    if last is not None:
+        columns = [np.concatenate([[value], column]) for value, column in zip(last, columns)]
+
+    shower = columns[0]
+    ordered = shower[1:] > shower[:-1]
+    if len(columns) > 1:
+        ordered |= (shower[1:] == shower[:-1]) & (columns[1][1:] >= columns[1][:-1])
+    else:
+        ordered |= shower[1:] == shower[:-1]
+    return bool(ordered.all())
+
+
+# Stream an output into a part, False if its rows turn out not to be sorted. The
+# columns that do not fit the compact schema are recorded in the part.
+def write_sorted(source, path, schema, keys, offset, hists=None):
+    last = None
+    misfits = set()
+    with pq.ParquetWriter(path, schema) as writer:
+        for batch in source.iter_batches(BATCH_ROWS):
+            table = pa.Table.from_batches([batch])
+            if table.num_rows == 0:
+                continue
+            if not in_order(table, keys, last):
+                return False
+            last = [table[key][-1].as_py() for key in keys]
+            if hists is not None:
+                hists.add(table)
+            table = shift_showers(table, offset)
+            misfits |= compact_misfits(table)
+            writer.write_table(table)
+        writer.add_key_value_metadata({MISFITS: ",".join(sorted(misfits))})
+    return True
+
+
+# Convert the outputs of one run into parts of the merged outputs
+def ingest(output_dir, run, pool=None):
+    if pool is None:
+        for dir in output_types:
+            ingest_output(output_dir, run, dir)
+        return
+    wait([pool.submit(ingest_output, output_dir, run, dir) for dir in output_types])
+
+
+# Columns written with 32 bits in the compact schema. pdg codes are dictionary
+# encoded in the parquet files even without dictionary encoding of the other
+# columns (pyarrow reads integer dictionaries back as plain integers).
+COMPACT_INTS = ("shower", "pdg")
+COMPACT_DICTIONARY = ["pdg"]
+COMPACT_FLOATS = ("kinetic_energy", "x", "y", "z", "nx", "ny", "nz", "time")
+
+# Largest absolute error of the float32 columns where it matters for the physics:
+# positions (in m) to 1 cm, arrival times (in s) to 1 ns and directions to 1e-6.
+# Beyond it the column keeps float64.
+FLOAT32_ATOL = {"x": 1e-2, "y": 1e-2, "z": 1e-2, "time": 1e-9, "nx": 1e-6, "ny": 1e-6, "nz": 1e-6}
+
+# Other float32 columns (kinetic energy) are only checked to be within the float32
+# range: rounding changes a value by at most 6e-8 of it, overflow and underflow by more
+FLOAT32_RANGE_RTOL = 1e-6
+
+
+# Key of the part metadata with the columns of a run that do not fit the compact schema
+MISFITS = "compact_misfits"
+
+
+# A column does not fit the type of the compact schema
+class PrecisionError(ValueError):
+    def __init__(self, column, type):
+        super().__init__(column + " does not fit " + str(type))
+        self.column = column
+
+
+# Schema with 32-bit shower, pdg, kinematics and positions, except the columns in keep
+def compact_schema(schema, keep=()):
+    fields = []
+    for field in schema:
+        if field.name not in keep and field.name in COMPACT_INTS and pa.types.is_integer(field.type):
+            field = field.with_type(pa.int32())
+        elif field.name not in keep and field.name in COMPACT_FLOATS and pa.types.is_float64(field.type):
+            field = field.with_type(pa.float32())
+        fields.append(field)
+    return pa.schema(fields)
+
+
+# Cast a column to a type of the compact schema, None if it does not fit. Integers
+# are cast safely and floats are compared after casting, with the absolute
+# tolerance of the column or within the float32 range.
+def cast_column(name, column, type):
+    try:
+        cast = pc.cast(column, type)
+    except pa.ArrowInvalid:
+        return None
+    if pa.types.is_float32(type):
+        error = pc.abs(pc.subtract(pc.cast(cast, column.type), column))
+        if name in FLOAT32_ATOL:
+            tolerance = pa.scalar(FLOAT32_ATOL[name], column.type)
+        else:
+            tolerance = pc.multiply(pc.abs(column), FLOAT32_RANGE_RTOL)
+        close = pc.or_(pc.less_equal(error, tolerance), pc.is_nan(column))
+        if not pc.all(close).as_py():
+            return None
+    return cast
+
+
+# Columns of a table that do not fit the compact schema
+def compact_misfits(table):
+    return {field.name for field in compact_schema(table.schema) if field.type != table.schema.field(field.name).type
+        and cast_column(field.name, table[field.name], field.type) is None}
+
+
+# Columns of a part that do not fit the compact schema, checked now for parts
+# ingested before they were recorded
+def part_misfits(part):
+    metadata = pq.read_metadata(part).metadata or {}
+    if MISFITS.encode() in metadata:
+        return {name for name in metadata[MISFITS.encode()].decode().split(",") if name}
+
+    misfits = set()
+    with pq.ParquetFile(part) as source:
+        for batch in source.iter_batches(BATCH_ROWS):
+            misfits |= compact_misfits(pa.Table.from_batches([batch]))
+    return misfits
+
+
+# Cast a table to the schema of a merged output, a PrecisionError names the
+# column that does not fit
+def cast_table(table, schema):
+    columns = []
+    for field in schema:
+        column = table[field.name]
+        if column.type != field.type:
+            column = cast_column(field.name, column, field.type)
+            if column is None:
+                raise PrecisionError(field.name, field.type)
+        columns.append(column)
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+# Writes tables sorted by shower in row groups of whole showers of about
+# group_rows rows, a larger shower gets row groups of its own. Records the row
+# groups and rows of each shower.
+class ShowerWriter:
+    def __init__(self, writer, group_rows=BATCH_ROWS):
+        self.writer = writer
+        self.group_rows = group_rows
+        self.pending = []
+        self.n_pending = 0
+        self.rows = 0
+        self.row_groups = 0
+        # Shower -> [first row group, last row group, first row, end row]
+        self.index = {}
+
+    def write(self, table):
+        self.pending.append(table)
+        self.n_pending += table.num_rows
+        if self.n_pending > self.group_rows:
+            self.flush(False)
+
+    # Pack the pending showers into row groups of up to group_rows rows. Unless
+    # at the end, the rows of the last group are kept, as they may be packed with
+    # the next showers or the last shower may continue in the next table.
+    def flush(self, final=True):
+        if not self.n_pending:
+            return
+        table = pa.concat_tables(self.pending)
+        shower = table["shower"].to_numpy()
+        starts = np.flatnonzero(np.diff(shower, prepend=shower[0] - 1))
+        ends = np.append(starts[1:], table.num_rows)
+
+        # First row of the current row group
+        group = 0
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            # Close the group before the next shower if it would get too large, or
+            # if it holds the rest of a large shower written in groups before
+            if start > group and (end - group > self.group_rows or int(shower[group]) in self.index):
+                self.write_group(table.slice(group, start - group))
+                group = start
+            # A large shower gets row groups of its own
+            while end - group > self.group_rows:
+                self.write_group(table.slice(group, self.group_rows))
+                group += self.group_rows
+
+        if final:
+            self.write_group(table.slice(group))
+            group = table.num_rows
+        self.pending = [table.slice(group)]
+        self.n_pending = table.num_rows - group
+
+    def write_group(self, table):
+        if not table.num_rows:
+            return
+        self.writer.write_table(table, row_group_size=table.num_rows)
 
-    # Shift shower index
-    id_shw += n_shw
-    # But not for the first run
-    if (run == 0): id_shw = 0
+        showers, starts = np.unique(table["shower"].to_numpy(), return_index=True)
+        ends = np.append(starts[1:], table.num_rows)
+        for shower, start, end in zip(showers.tolist(), starts.tolist(), ends.tolist()):
+            if shower in self.index:
+                self.index[shower][1] = self.row_groups
+                self.index[shower][3] = self.rows + end
+            else:
+                self.index[shower] = [self.row_groups, self.row_groups, self.rows + start, self.rows + end]
 
-    # Iterate over output directories and files
-    for dir, file in output_types.items():
-        # print("  - processing output dir '", dir, "' (file '", file, ".parquet')", sep="")
+        self.rows += table.num_rows
+        self.row_groups += 1
 
-        # Compose output file name
-        output_file = output_dir + "/run_" + str(run) + "/" + dir + "/" + file + ".parquet"
+    def write_index(self, path):
+        showers = sorted(self.index)
+        columns = list(zip(*[self.index[shower] for shower in showers])) or [[], [], [], []]
+        table = pa.table({"shower": pa.array(showers, pa.int64()),
+                          "row_group_first": pa.array(columns[0], pa.int32()),
+                          "row_group_last": pa.array(columns[1], pa.int32()),
+                          "row_start": pa.array(columns[2], pa.int64()),
+                          "row_end": pa.array(columns[3], pa.int64())})
+        pq.write_table(table, path + ".tmp")
+        os.replace(path + ".tmp", path)
 
-        # Read from parquet file as dataframe
-        data[dir][run] = pd.read_parquet(output_file, "pyarrow")
 
-        # Shift shower indices
-        data[dir][run]["shower"] = data[dir][run]["shower"] + id_shw
+# Join the histograms of all runs, given the shower offset of each run
+def write_histograms(output_dir, runs):
+    path = output_dir + "/merged/" + HISTOGRAMS + ".parquet"
+    writer = None
+    for entry in runs:
+        table = pq.read_table(part_file(output_dir, HISTOGRAMS, entry["run"]))
+        metadata = table.schema.metadata
+        table = shift_showers(table, entry["offset"] - int(metadata[b"shower_offset"]))
+        if writer is None:
+            del metadata[b"shower_offset"]
+            writer = pq.ParquetWriter(path + ".tmp", table.schema.with_metadata(metadata))
+        writer.write_table(table.replace_schema_metadata(writer.schema.metadata))
 
-runtime_file.close()
+    if writer is not None:
+        writer.close()
+        os.replace(path + ".tmp", path)
 
-# Iterate over outputs to make merged files
-for dir, file in output_types.items():
+
+# Check whether an output derived from all segments has to be written again
+def needs_update(segments, path):
+    return bool(segments) and (any(rewrite for _, _, rewrite in segments) or not os.path.isfile(path))
+
+
+# Summary of a merged output per X: count, sum, sum of squares, median and
+# quartiles of every column, e.g. 'total_median' for the energy loss
+def summary_file(output_dir, dir):
+    return output_dir + "/merged/" + dir + "/" + output_types[dir] + ".summary.parquet"
+
+
+def write_summary(output_dir, dir, n_segments):
+    files = [segment_file(output_dir, dir, segment) for segment in range(n_segments)]
+    source = ds.dataset(files, format="parquet")
+    data = source.to_table(columns=[name for name in source.schema.names if name != "shower"]).to_pandas()
+    for name, columns in SUMMARY_SUMS[dir].items():
+        data[name] = sum(data[column] for column in columns)
+
+    columns = [column for column in data.columns if column != "X"]
+    grouped = data.groupby("X")[columns]
+    stats = {"count": grouped.count(),
+             "sum": grouped.sum(),
+             "sumsq": data[columns].astype("float64").pow(2).groupby(data["X"]).sum(),
+             "median": grouped.median(),
+             "q25": grouped.quantile(0.25),
+             "q75": grouped.quantile(0.75)}
+
+    summary = pd.concat([stats[stat].add_suffix("_" + stat) for stat in stats], axis=1)
+    summary = summary[[column + "_" + stat for column in columns for stat in stats]].reset_index()
+    path = summary_file(output_dir, dir)
+    summary.to_parquet(path + ".tmp", engine="pyarrow", index=False)
+    os.replace(path + ".tmp", path)
+
+
+# Rows of one shower of a merged file, reading only its row groups
+def read_shower(merged_file, shower, columns=None):
+    index = pq.read_table(index_file(merged_file), filters=[("shower", "==", shower)]).to_pylist()
+    with pq.ParquetFile(merged_file) as source:
+        if not index:
+            return source.schema_arrow.empty_table().select(columns or source.schema_arrow.names)
+        entry = index[0]
+        first = sum(source.metadata.row_group(i).num_rows for i in range(entry["row_group_first"]))
+        table = source.read_row_groups(range(entry["row_group_first"], entry["row_group_last"] + 1), columns)
+        return table.slice(entry["row_start"] - first, entry["row_end"] - entry["row_start"])
+
+
+# Iterate over the showers of a merged file as (shower, table), reading each row group once
+def iter_showers(merged_file, columns=None):
+    index = pq.read_table(index_file(merged_file)).to_pylist()
+    with pq.ParquetFile(merged_file) as source:
+        starts = np.cumsum([0] + [source.metadata.row_group(i).num_rows for i in range(source.num_row_groups)])
+        groups = {}
+        for entry in index:
+            # Drop row groups of earlier showers
+            groups = {i: groups[i] for i in groups if i >= entry["row_group_first"]}
+            for i in range(entry["row_group_first"], entry["row_group_last"] + 1):
+                if i not in groups:
+                    groups[i] = source.read_row_group(i, columns)
+            table = pa.concat_tables([groups[i] for i in range(entry["row_group_first"], entry["row_group_last"] + 1)])
+            start = entry["row_start"] - starts[entry["row_group_first"]]
+            yield entry["shower"], table.slice(start, entry["row_end"] - entry["row_start"])
+
+
+def write_segment(merged_file, parts, compact, keep, format=DEFAULT_FORMAT):
+    writer = None
+    try:
+        for part, shift in parts:
+            with pq.ParquetFile(part) as source:
+                if writer is None:
+                    schema = source.schema_arrow.remove_metadata()
+                    if compact:
+                        schema = compact_schema(schema, keep)
+                    writer = ShowerWriter(pq.ParquetWriter(merged_file + ".tmp", schema, **parquet_options(format, compact)),
+                        format["row_group_rows"])
+
+                for batch in source.iter_batches(BATCH_ROWS):
+                    table = shift_showers(pa.Table.from_batches([batch]), shift)
+                    if not table.schema.equals(writer.writer.schema):
+                        table = cast_table(table, writer.writer.schema)
+                    writer.write(table)
+        if writer is not None:
+            writer.flush()
+    finally:
+        if writer is not None:
+            writer.writer.close()
+
+    if writer is not None:
+        writer.write_index(index_file(merged_file))
+        os.replace(merged_file + ".tmp", merged_file)
+
+
+# Join the parts of runs into one segment of a merged output, given the runs and
+# their shower offsets. Parts are streamed in record batches through one writer
+# in the order of the runs, so only one batch is in memory at a time. With the
+# compact schema, the columns in keep are written with their type.
+def join_output(output_dir, dir, segment, runs, compact=False, keep=(), format=DEFAULT_FORMAT):
     # Make a directory for the merged output
     os.makedirs(output_dir + "/merged/" + dir, exist_ok=True)
+    merged_file = segment_file(output_dir, dir, segment)
+
+    parts = []
+    for run, offset in runs:
+        part = part_file(output_dir, dir, run)
+        # Correct the shower offset guessed when ingesting
+        parts.append((part, offset - int(pq.read_schema(part).metadata[b"shower_offset"])))
+
+    write_segment(merged_file, parts, compact, keep, format)
+
+
+# Columns of each output that keep their type in the compact schema, for all
+# segments and dataset partitions alike: those of the last merge and those that do
+# not fit for any run to be written. If they grow, all segments and partitions
+# are written again, ingesting their runs. Returns the columns, the segments and
+# the dataset runs.
+def plan_compact(output_dir, runs, segments, dataset_runs, dataset, pool):
+    manifest = read_manifest(output_dir)
+    last = {dir: set(columns) for dir, columns in manifest.get("keep", {}).items()} if manifest.get("compact", False) else {}
+    present = [entry["run"] for entry in runs]
+
+    while True:
+        # Decided from scratch if everything is written again
+        everything = all(rewrite for _, _, rewrite in segments) and (not dataset or dataset_runs == present)
+        keep = {dir: set() if everything else set(last.get(dir, ())) for dir in output_types}
+        written = set(dataset_runs)
+        for first, end, rewrite in segments:
+            if rewrite:
+                written.update(run for run in present if first <= run < end)
+        for dir in output_types:
+            for run in sorted(written):
+                keep[dir] |= part_misfits(part_file(output_dir, dir, run))
+
+        if everything or all(keep[dir] == last.get(dir, set()) for dir in output_types):
+            break
+        print("Compact schema of '", output_dir, "' changed, writing all runs again", sep="")
+        segments = [[first, end, True] for first, end, _ in segments]
+        dataset_runs = present if dataset else []
+        wait([pool.submit(ingest_output, output_dir, run, dir) for run in present
+            if not is_ingested(output_dir, run, list(output_types)) for dir in output_types])
+
+    for dir in output_types:
+        if keep[dir]:
+            print("  - ", dir, ": keeping the type of ", ", ".join(sorted(keep[dir])), ", too imprecise in the compact schema",
+                sep="")
+    return keep, segments, dataset_runs
+
+
+def dataset_dir(output_dir, dir):
+    return output_dir + "/merged/" + DATASET + "/" + dir
+
+
+# Family of each particle in a pdg column
+def particle_family(pdg):
+    code = pc.abs(pdg)
+    family = pc.if_else(pc.greater_equal(code, 100), "hadron", "other")
+    for value, name in FAMILIES.items():
+        family = pc.if_else(pc.equal(code, value), name, family)
+    return family
+
+
+# Remove the partitions of a run from the dataset of an output
+def remove_run_dataset(output_dir, dir, run):
+    base = dataset_dir(output_dir, dir)
+    for path in glob.glob(base + "/run=" + str(run)) + glob.glob(base + "/*/run=" + str(run)):
+        shutil.rmtree(path)
+
+
+def write_dataset(output_dir, dir, run, shift, compact, keep, format=DEFAULT_FORMAT):
+    remove_run_dataset(output_dir, dir, run)
+
+    with pq.ParquetFile(part_file(output_dir, dir, run)) as source:
+        schema = source.schema_arrow.remove_metadata()
+        if compact:
+            schema = compact_schema(schema, keep)
+
+        # Particles are partitioned by family first, so reading one family
+        # touches only its directory
+        keys = [pa.field("run", pa.int32())]
+        if dir == "particles":
+            keys.insert(0, pa.field("family", pa.string()))
+        full = schema
+        for key in keys:
+            full = full.append(key)
+
+        def batches():
+            for batch in source.iter_batches(BATCH_ROWS):
+                table = shift_showers(pa.Table.from_batches([batch]), shift)
+                if not table.schema.equals(schema):
+                    table = cast_table(table, schema)
+                if dir == "particles":
+                    table = table.append_column("family", particle_family(table["pdg"]))
+                table = table.append_column("run", pa.array([run] * table.num_rows, pa.int32()))
+                yield from table.to_batches()
+
+        ds.write_dataset(batches(), dataset_dir(output_dir, dir), schema=full, format="parquet",
+            file_options=ds.ParquetFileFormat().make_write_options(**parquet_options(format, compact)),
+            partitioning=ds.partitioning(pa.schema(keys), flavor="hive"), basename_template="part-{i}.parquet",
+            existing_data_behavior="overwrite_or_ignore", min_rows_per_group=format["row_group_rows"],
+            max_rows_per_group=format["row_group_rows"], preserve_order=True)
+
+
+# Write the outputs of one run into the partitioned datasets, given the shower
+# offset of the run
+def write_run_dataset(output_dir, dir, run, offset, compact=False, keep=(), format=DEFAULT_FORMAT):
+    shift = offset - int(pq.read_schema(part_file(output_dir, dir, run)).metadata[b"shower_offset"])
+    write_dataset(output_dir, dir, run, shift, compact, keep, format)
+
+
+# Wait for tasks of the pool, raising the first error
+def wait(futures):
+    for future in futures:
+        future.result()
+
+
+# Merge resource telemetry of runs that were started with the telemetry wrapper
+def merge_telemetry(output_dir, run_list):
+    telemetry_rows = []
+    telemetry_series = []
+    for run in run_list:
+        run_dir = output_dir + "/run_" + str(run)
+
+        # Summary of rusage and I/O counters
+        if os.path.isfile(run_dir + "/telemetry.yaml"):
+            row = {"run": run}
+            with open(run_dir + "/telemetry.yaml", "r") as file:
+                for line in file:
+                    key, _, value = line.partition(":")
+                    row[key.strip()] = float(value)
+            telemetry_rows.append(row)
+
+        # Sampled RSS and CPU usage
+        if os.path.isfile(run_dir + "/telemetry.parquet"):
+            series = pd.read_parquet(run_dir + "/telemetry.parquet", "pyarrow")
+            series.insert(0, "run", run)
+            telemetry_series.append(series)
+
+    if telemetry_rows:
+        print("Merging telemetry of", len(telemetry_rows), "runs")
+        pd.DataFrame(telemetry_rows).to_csv(output_dir + "/merged/telemetry.csv", index=False)
+    if telemetry_series:
+        pd.concat(telemetry_series).to_parquet(output_dir + "/merged/telemetry.parquet", compression="zstd")
+
+
+# Compare the runs of a simulation with the manifest of the last merge. Returns
+# the runs with their shower offsets, the runs that are not ingested yet, the
+# segments of the merged files, each as [first run, end run, rewrite] of run
+# indices, and the runs to write into the partitioned dataset.
+def plan(output_dir, rebuild=False, compact=False, dataset=False, format=DEFAULT_FORMAT):
+    # Make a directory for merged outputs
+    os.makedirs(output_dir + "/merged", exist_ok=True)
+
+    manifest = read_manifest(output_dir)
+    known = {entry["run"]: entry for entry in manifest["runs"]}
+
+    # Current shower id, used for shifting shower indices
+    id_shw = 0
+    runs = []
+    changed = set()
+
+    # Iterate over runs in this simulation
+    for run in run_indices(output_dir):
+        print("Processing run", run)
+
+        # Runs without all outputs, e.g. of a failed run, are left out like removed ones
+        if not is_complete(output_dir, run):
+            print("  - incomplete, not merged")
+            continue
+
+        signature = run_signature(output_dir, run)
+        entry = known.get(run)
+        if entry is not None and entry["size"] == signature["size"] and entry["mtime"] == signature["mtime"]:
+            n_shw, runtime = entry["showers"], entry["runtime"]
+        else:
+            # Open summary file to read number of showers
+            n_shw, runtime = read_summary(output_dir, run)
+        print("  - showers = ", n_shw, "runtime = ", runtime)
+
+        # Showers of a run are numbered after all showers of the previous runs
+        runs.append(dict(run=run, showers=n_shw, runtime=runtime, offset=id_shw, **signature))
+        id_shw += n_shw
+
+        # Runs (or their shower numbers) that differ from the last merge are joined again
+        if runs[-1] == entry:
+            print("  - already merged")
+        else:
+            changed.add(run)
+
+    # Removed runs change the segments they were merged into
+    present = [entry["run"] for entry in runs]
+    removed = sorted(set(known) - set(present))
+    if removed:
+        print("Removed since the last merge: run(s)", ", ".join(str(run) for run in removed))
+    changed.update(removed)
+    n_end = present[-1] + 1 if present else 0
+
+    # Keep segments of unchanged runs, truncate segments of removed runs and
+    # append a segment with the new runs. Segments left without runs are dropped,
+    # which moves the files of the following segments.
+    segments = []
+    moved = False
+    for first, end in manifest["segments"]:
+        if first >= n_end:
+            break
+        if not any(first <= run < end for run in present):
+            moved = True
+            continue
+        rewrite = moved or end > n_end or any(run in changed for run in range(first, end))
+        for dir in output_types:
+            merged_file = segment_file(output_dir, dir, len(segments))
+            if not os.path.isfile(merged_file) or not os.path.isfile(index_file(merged_file)):
+                rewrite = True
+        segments.append([first, min(end, n_end), rewrite])
+    end = segments[-1][1] if segments else 0
+    if end < n_end:
+        segments.append([end, n_end, True])
+
+    # Changing the schema or the parquet settings rewrites all segments
+    new_schema = manifest.get("compact", False) != compact or manifest.get("format", DEFAULT_FORMAT) != format
+    if (rebuild or len(segments) > MAX_SEGMENTS or new_schema) and present:
+        segments = [[0, n_end, True]]
+
+    # Dataset partitions are written per run
+    dataset_runs = []
+    if dataset:
+        if rebuild or new_schema or not manifest.get("dataset", False):
+            dataset_runs = present
+        else:
+            dataset_runs = sorted(changed.intersection(present))
+
+    # Runs ingested while the simulation was running are not read again. Runs of
+    # rewritten segments and of the dataset need all their parts, the histograms
+    # only the histogram parts of all runs.
+    needed = set(dataset_runs)
+    for first, end, rewrite in segments:
+        if rewrite:
+            needed.update(range(first, end))
+    hists = needs_update(segments, output_dir + "/merged/" + HISTOGRAMS + ".parquet")
+    pending = [run for run in present if (run in needed and not is_ingested(output_dir, run))
+        or (hists and not is_ingested(output_dir, run, [HISTOGRAMS]))]
+
+    return runs, pending, segments, dataset_runs
+
+
+# Write the runtimes of a simulation, also into the runtime database, the manifest
+# and remove segments beyond the last one, partitions of removed runs, the
+# dataset if it was not written and the merged parts
+def finish(output_dir, runs, segments, compact=False, dataset=False, format=DEFAULT_FORMAT, keep=None):
+    # Create a file with runtimes
+    with open(output_dir + "/merged/runtimes.csv", "w") as runtime_file:
+        # Write header
+        runtime_file.write("run,showers,runtime\n")
+        for entry in runs:
+            runtime_file.write(",".join([str(entry["run"]),str(entry["showers"]),str(entry["runtime"]),"\n"]))
+
+    # All fields of the run summaries in the runtime database of all simulations
+    db = rt.RuntimeDB(os.path.join(os.path.dirname(output_dir), rt.DATABASE))
+    db.update(output_dir)
+    db.close()
+
+    for dir in output_types:
+        files = [segment_file(output_dir, dir, segment) for segment in range(len(segments))]
+        files += [index_file(f) for f in files]
+        for path in glob.glob(output_dir + "/merged/" + dir + "/" + output_types[dir] + "_*.parquet"):
+            if path not in files:
+                os.remove(path)
+
+    present = {entry["run"] for entry in runs}
+    if dataset:
+        for dir in output_types:
+            for path in glob.glob(dataset_dir(output_dir, dir) + "/run=*") + glob.glob(dataset_dir(output_dir, dir) + "/*/run=*"):
+                if int(path.rpartition("=")[2]) not in present:
+                    shutil.rmtree(path)
+    elif os.path.isdir(output_dir + "/merged/" + DATASET):
+        shutil.rmtree(output_dir + "/merged/" + DATASET)
+
+    # Parts of merged runs are a copy of the run outputs, they are ingested again
+    # if a segment of the run has to be rewritten
+    for entry in runs:
+        for dir in output_types:
+            if os.path.isfile(part_file(output_dir, dir, entry["run"])):
+                os.remove(part_file(output_dir, dir, entry["run"]))
+    for path in glob.glob(output_dir + "/merged/" + PARTS + "/*/run_*.parquet"):
+        if int(os.path.basename(path)[4:-len(".parquet")]) not in present:
+            os.remove(path)
+
+    write_manifest(output_dir, {"runs": runs, "segments": [[first, end] for first, end, _ in segments],
+        "compact": compact, "dataset": dataset, "format": format,
+        "keep": {dir: sorted(columns) for dir, columns in (keep or {}).items() if columns}})
+
+
+# Schema, dataset and parquet settings of a merge, those not given (None, or left
+# out of format) are kept from the last merge of the simulation
+def merge_settings(output_dir, compact=None, dataset=None, format=None):
+    manifest = read_manifest(output_dir)
+    if compact is None:
+        compact = manifest.get("compact", False)
+    if dataset is None:
+        dataset = manifest.get("dataset", False)
+    return compact, dataset, dict(manifest.get("format", DEFAULT_FORMAT), **(format or {}))
+
+
+# Merge simulations, decoding runs and joining output types of all simulations
+# in a pool of threads (pyarrow releases the GIL while decoding and writing).
+# Each segment of a merged file is written by one task in the order of the runs,
+# so the result does not depend on the number of jobs.
+def merge(output_dirs, jobs=1, rebuild=False, compact=None, dataset=None, format=None):
+    plans = {}
+    settings = {}
+    for output_dir in output_dirs:
+        print ("Simulation output: '", output_dir, "'", sep="")
+        settings[output_dir] = merge_settings(output_dir, compact, dataset, format)
+        plans[output_dir] = plan(output_dir, rebuild, *settings[output_dir])
+
+    with ThreadPoolExecutor(jobs) as pool:
+        wait([pool.submit(ingest_output, output_dir, run, dir)
+            for output_dir, (_, pending, _, _) in plans.items() for run in pending for dir in output_types])
+
+        for output_dir in output_dirs:
+            merge_telemetry(output_dir, [entry["run"] for entry in plans[output_dir][0]])
+
+        # One compact schema per output for all its files
+        keeps = {}
+        for output_dir, (runs, pending, segments, dataset_runs) in plans.items():
+            compact, dataset, _ = settings[output_dir]
+            keeps[output_dir] = {}
+            if compact:
+                keeps[output_dir], segments, dataset_runs = plan_compact(output_dir, runs, segments, dataset_runs,
+                    dataset, pool)
+                plans[output_dir] = runs, pending, segments, dataset_runs
+
+        # Iterate over outputs to make merged files, only segments with changed runs
+        tasks = []
+        for output_dir, (runs, _, segments, dataset_runs) in plans.items():
+            compact, _, format = settings[output_dir]
+            keep = keeps[output_dir]
+            for segment, (first, end, rewrite) in enumerate(segments):
+                if not rewrite:
+                    continue
+                print("Writing runs ", first, "-", end - 1, " of '", output_dir, "'", sep="")
+                tasks += [pool.submit(join_output, output_dir, dir, segment,
+                    [(entry["run"], entry["offset"]) for entry in runs if first <= entry["run"] < end], compact,
+                    keep.get(dir, ()), format) for dir in output_types]
+
+            if dataset_runs:
+                print("Writing ", len(dataset_runs), " run(s) to the dataset of '", output_dir, "'", sep="")
+            offsets = {entry["run"]: entry["offset"] for entry in runs}
+            tasks += [pool.submit(write_run_dataset, output_dir, dir, run, offsets[run], compact, keep.get(dir, ()),
+                format) for run in dataset_runs for dir in output_types]
+        wait(tasks)
+
+        # Summaries and histograms of changed outputs
+        tasks = []
+        for output_dir, (runs, _, segments, _) in plans.items():
+            for dir in SUMMARY_SUMS:
+                if needs_update(segments, summary_file(output_dir, dir)):
+                    tasks.append(pool.submit(write_summary, output_dir, dir, len(segments)))
+            if needs_update(segments, output_dir + "/merged/" + HISTOGRAMS + ".parquet"):
+                tasks.append(pool.submit(write_histograms, output_dir, runs))
+        wait(tasks)
+
+    for output_dir, (runs, _, segments, _) in plans.items():
+        finish(output_dir, runs, segments, *settings[output_dir], keeps[output_dir])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge parquet outputs of all runs of a simulation")
+    parser.add_argument("sim_names", nargs="+", metavar="sim_name", help="simulation names (directories in output/)")
+    parser.add_argument("--ingest", type=int, default=None, metavar="RUN",
+        help="only ingest the outputs of this run, e.g. as soon as it finished")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+        help="number of runs and outputs decoded and written in parallel (default: 1)")
+    parser.add_argument("--rebuild", action="store_true",
+        help="merge all runs into one file per output again instead of appending new runs")
+    parser.add_argument("--compact", action=argparse.BooleanOptionalAction, default=None,
+        help="write shower and pdg as int32 and kinematics and positions as float32 where they keep their precision "
+        "(default: as in the last merge)")
+    parser.add_argument("--dataset", action=argparse.BooleanOptionalAction, default=None,
+        help="also write a dataset partitioned by run and particle family to merged/dataset/ (default: as in the last merge)")
+    # Parquet settings not given are kept from the last merge, snappy with 65536 rows per row group at first
+    parser.add_argument("--codec", choices=CODECS, default=None,
+        help="compression of the merged outputs and the dataset (default: as in the last merge, or snappy)")
+    parser.add_argument("--codec-level", type=int, default=None, metavar="LEVEL",
+        help="compression level, e.g. 1-22 for zstd (default: as in the last merge, or default of the codec)")
+    parser.add_argument("--row-group-rows", type=int, default=None, metavar="N",
+        help="rows per row group, whole showers are kept together (default: as in the last merge, or 65536)")
+    parser.add_argument("--dictionary", action=argparse.BooleanOptionalAction, default=None,
+        help="dictionary encoding of all columns (default: as in the last merge, or on)")
+    parser.add_argument("--statistics", choices=("all", "shower"), default=None,
+        help="columns with row group statistics, 'shower' is enough for the index and validate "
+        "(default: as in the last merge, or all)")
+    args = parser.parse_args()
+    format = {key: value for key, value in (("codec", args.codec), ("level", args.codec_level),
+        ("row_group_rows", args.row_group_rows), ("dictionary", args.dictionary), ("statistics", args.statistics))
+        if value is not None}
+    # A new codec starts from its default level
+    if args.codec is not None:
+        format.setdefault("level", None)
 
-    # Merge dataframes from all runs
-    df_merge = pd.concat(data[dir])
+    # Directories with simulation outputs
+    output_dirs = ["output/" + name for name in args.sim_names]
 
-    # Write merged dataframe to a parquet file
-    df_merge.to_parquet(output_dir + "/merged/" + dir + "/" + file + ".parquet")
+    if args.ingest is not None:
+        with ThreadPoolExecutor(args.jobs) as pool:
+            for output_dir in output_dirs:
+                print("Ingesting run ", args.ingest, " of '", output_dir, "'", sep="")
+                ingest(output_dir, args.ingest, pool)
+    else:
+        merge(output_dirs, args.jobs, args.rebuild, args.compact, args.dataset, format)
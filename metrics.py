@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+# Throughput and progress metrics of simulations from the ledger, exported in the
+# Prometheus textfile format and printed by the status subcommand
+
+import asyncio
+import os
+import time
+
+import numpy as np
+
+import costmodel as cm
+import ledger as lg
+
+
+# Seconds between updates of the metrics file
+INTERVAL = 15
+
+# Showers/hour are measured over runs that finished within this many seconds
+WINDOW = 3600
+
+
+# Statistics of one simulation from its ledger rows
+def sim_stats(rows, now):
+    stats = {state: 0 for state in (lg.QUEUED, lg.RUNNING, lg.DONE, lg.FAILED)}
+    for row in rows:
+        stats[row["state"]] += 1
+
+    stats["showers"] = sum(row["showers"] for row in rows if row["state"] == lg.DONE)
+
+    # Timing only of runs simulated here, not of outputs found or taken from the cache
+    done = [row for row in rows if row["state"] == lg.DONE and row["start_time"] and row["end_time"]
+        and row["message"] != "cached"]
+    running = [row for row in rows if row["state"] == lg.RUNNING and row["start_time"]]
+    durations = np.array([row["end_time"] - row["start_time"] for row in done])
+    stats["mean"] = float(durations.mean()) if len(durations) else None
+    stats["p95"] = float(np.percentile(durations, 95)) if len(durations) else None
+
+    # Throughput of the runs finished recently, up to now while runs are active
+    recent = [row for row in done if row["end_time"] >= now - WINDOW]
+    stats["showers_per_hour"] = 0.0
+    if recent:
+        t_start = min(row["start_time"] for row in recent + running)
+        t_end = now if running or stats[lg.QUEUED] else max(row["end_time"] for row in recent)
+        if t_end > t_start:
+            stats["showers_per_hour"] = sum(row["showers"] for row in recent) / (t_end - t_start) * 3600
+
+    # Remaining work with the mean run time, running runs count what is left of it
+    stats["work"] = None
+    if stats["mean"] is not None:
+        stats["work"] = stats[lg.QUEUED] * stats["mean"]
+        stats["work"] += sum(max(stats["mean"] - (now - row["start_time"]), 0) for row in running)
+
+    return stats
+
+
+# Statistics of all simulations in the ledger and the runs busy per host
+def collect(ledger, sim=None):
+    now = time.time()
+    rows = ledger.rows(sim=sim)
+
+    sims = {}
+    for row in rows:
+        sims.setdefault(row["sim"], []).append(row)
+    stats = {name: sim_stats(sim_rows, now) for name, sim_rows in sims.items()}
+
+    busy = {}
+    for row in rows:
+        if row["state"] == lg.RUNNING:
+            host = row["host"] or "unknown"
+            busy[host] = busy.get(host, 0) + 1
+
+    return stats, busy
+
+
+# Seconds until all simulations are done, with the remaining work spread over the busy cores
+def eta(stats, busy):
+    work = [s["work"] for s in stats.values() if s["work"]]
+    cores = sum(busy.values())
+    if not work or not cores:
+        return None
+    return sum(work) / cores
+
+
+def format_labels(labels):
+    return "{" + ",".join('{}="{}"'.format(k, v) for k, v in labels.items()) + "}" if labels else ""
+
+
+# Write the metrics file, replaced atomically so the node exporter never reads half of it
+def write_textfile(path, stats, busy, threads=None):
+    metrics = {}
+
+    def add(name, help, labels, value):
+        if value is None:
+            return
+        metrics.setdefault(name, (help, []))[1].append((labels, value))
+
+    for sim, s in stats.items():
+        for state in (lg.QUEUED, lg.RUNNING, lg.DONE, lg.FAILED):
+            add("c8_runs", "Runs of a simulation by state", {"sim": sim, "state": state}, s[state])
+        add("c8_showers_done", "Showers of finished runs", {"sim": sim}, s["showers"])
+        add("c8_showers_per_hour", "Showers per hour of the runs finished in the last hour", {"sim": sim},
+            s["showers_per_hour"])
+        add("c8_run_seconds_mean", "Mean wall time of finished runs", {"sim": sim}, s["mean"])
+        add("c8_run_seconds_p95", "95th percentile of the wall time of finished runs", {"sim": sim}, s["p95"])
+        add("c8_remaining_seconds", "Remaining run time of a simulation on one core", {"sim": sim}, s["work"])
+
+    for host, n in busy.items():
+        add("c8_cores_busy", "Runs currently running", {"host": host}, n)
+    add("c8_cores_total", "Concurrent runs of the scheduler", {}, threads)
+    add("c8_eta_seconds", "Estimated seconds until all simulations are done", {}, eta(stats, busy))
+    add("c8_metrics_timestamp_seconds", "Time of the last update", {}, time.time())
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + ".tmp", "w") as file:
+        for name, (help, samples) in metrics.items():
+            file.write("# HELP {} {}\n".format(name, help))
+            file.write("# TYPE {} gauge\n".format(name))
+            for labels, value in samples:
+                file.write("{}{} {}\n".format(name, format_labels(labels), value))
+    os.replace(path + ".tmp", path)
+
+
+# Update the metrics file until cancelled, and once more at the end
+async def export(ledger, path, threads=None, interval=INTERVAL):
+    try:
+        while True:
+            write_textfile(path, *collect(ledger), threads)
+            await asyncio.sleep(interval)
+    finally:
+        write_textfile(path, *collect(ledger), threads)
+
+
+def format_optional(value, fmt):
+    return "-" if value is None else fmt(value)
+
+
+# Print the state of all simulations in the ledger
+def print_status(stats, busy):
+    if not stats:
+        print("No runs in the ledger")
+        return
+
+    print("{:50s} {:>6s} {:>7s} {:>6s} {:>6s} {:>10s} {:>9s} {:>9s}".format(
+        "Simulation", "queued", "running", "done", "failed", "showers/h", "mean", "p95"))
+    for sim, s in sorted(stats.items()):
+        print("{:50s} {:6d} {:7d} {:6d} {:6d} {:>10s} {:>9s} {:>9s}".format(sim, s[lg.QUEUED], s[lg.RUNNING],
+            s[lg.DONE], s[lg.FAILED], "{:.1f}".format(s["showers_per_hour"]) if s["showers_per_hour"] else "-",
+            format_optional(s["mean"], cm.format_duration), format_optional(s["p95"], cm.format_duration)))
+
+    print("Cores busy:", sum(busy.values()), "".join(" ({}: {})".format(h, n) for h, n in sorted(busy.items())))
+    remaining = eta(stats, busy)
+    if remaining is not None:
+        print("ETA:", cm.format_duration(remaining), time.strftime("(%Y-%m-%d %H:%M)", time.localtime(time.time() + remaining)))
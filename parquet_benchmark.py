@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+# Benchmark of the parquet settings of merge_outputs.py: rewrites a sample of the
+# merged outputs of a simulation with each combination of codec, row group size,
+# dictionary encoding and statistics, and measures the size, write throughput and
+# read times of the access patterns of analysis.py
+
+import argparse
+import itertools
+import os
+import tempfile
+import time
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as csv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import merge_outputs as mo
+
+
+# Results in the merged directory of the simulation
+RESULTS = "parquet_benchmark.csv"
+
+# Reads of analysis.py as {output: {name: (columns, filter)}}, and one shower
+# through the index for every output
+PATTERNS = {"particles": {"photons": (["shower", "pdg", "x", "y", "kinetic_energy"], pc.abs(ds.field("pdg")) == 22),
+                          "muons": (["shower", "pdg", "x", "y", "kinetic_energy"], pc.abs(ds.field("pdg")) == 13)},
+            "energyloss": {"total": (["X", "total"], None)},
+            "profile": {"species": (["X", "electron", "positron", "muplus", "muminus", "photon", "hadron"], None)},
+            "production_profile": {"muon_hadron": (["X", "muon", "hadron"], None)},
+            "interactions": {}}
+
+
+# Best time of repeated calls
+def best_time(call, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        call()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+# Rows of the first showers of an output, from its first merged segment
+def sample(output_dir, dir, n_showers):
+    return pq.read_table(mo.segment_file(output_dir, dir, 0), filters=[("shower", "<", n_showers)])
+
+
+# Write a sample as merge_outputs.py does, returns the seconds spent
+def write(table, path, format):
+    start = time.perf_counter()
+    writer = mo.ShowerWriter(pq.ParquetWriter(path + ".tmp", table.schema, **mo.parquet_options(format)),
+        format["row_group_rows"])
+    try:
+        for batch in table.to_batches(mo.BATCH_ROWS):
+            writer.write(pa.Table.from_batches([batch]))
+        writer.flush()
+    finally:
+        writer.writer.close()
+    elapsed = time.perf_counter() - start
+
+    writer.write_index(mo.index_file(path))
+    os.replace(path + ".tmp", path)
+    return elapsed
+
+
+# Size, write throughput and read times of one output with one format
+def measure(table, path, dir, format, repeats):
+    seconds = write(table, path, format)
+    result = dict(output=dir, **format, rows=table.num_rows, size_mb=os.path.getsize(path) / 1e6,
+        write_mb_s=table.nbytes / 1e6 / seconds)
+
+    for name, (columns, filter) in PATTERNS[dir].items():
+        read = lambda: ds.dataset(path, format="parquet").to_table(columns=columns, filter=filter)
+        result["read_" + name + "_ms"] = best_time(read, repeats) * 1e3
+    shower = table["shower"][table.num_rows // 2].as_py()
+    result["read_shower_ms"] = best_time(lambda: mo.read_shower(path, shower), repeats) * 1e3
+    return result
+
+
+# Formats of all combinations, codecs given as 'name' or 'name:level'
+def formats(codecs, row_groups):
+    for codec, rows, dictionary, statistics in itertools.product(codecs, row_groups, (True, False), ("all", "shower")):
+        name, _, level = codec.partition(":")
+        yield {"codec": name, "level": int(level) if level else None, "row_group_rows": rows,
+               "dictionary": dictionary, "statistics": statistics}
+
+
+def read_time(result):
+    return sum(value for key, value in result.items() if key.startswith("read_"))
+
+
+# Print the results of each output sorted by size, and the format with the
+# shortest reads of all outputs within 10% of the smallest total size
+def report(results):
+    for dir in mo.output_types:
+        rows = sorted([r for r in results if r["output"] == dir], key=lambda r: r["size_mb"])
+        if not rows:
+            continue
+        print("  - ", dir, ": ", rows[0]["rows"], " rows", sep="")
+        reads = [key for key in rows[0] if key.startswith("read_")]
+        print("      {:>6s} {:>5s} {:>8s} {:>4s} {:>6s} {:>9s} {:>10s}".format("codec", "level", "rows/rg", "dict",
+            "stats", "size [MB]", "write MB/s") + "".join(" {:>14s}".format(key[5:]) for key in reads))
+        for r in rows:
+            print("      {:>6s} {:>5s} {:>8d} {:>4s} {:>6s} {:9.2f} {:10.1f}".format(r["codec"], str(r["level"] or "-"),
+                r["row_group_rows"], "yes" if r["dictionary"] else "no", r["statistics"], r["size_mb"], r["write_mb_s"])
+                + "".join(" {:14.2f}".format(r[key]) for key in reads))
+
+    totals = {}
+    for r in results:
+        key = (r["codec"], r["level"], r["row_group_rows"], r["dictionary"], r["statistics"])
+        size, reads = totals.get(key, (0, 0))
+        totals[key] = (size + r["size_mb"], reads + read_time(r))
+    smallest = min(size for size, _ in totals.values())
+    codec, level, rows, dictionary, statistics = min((k for k, (size, _) in totals.items() if size <= 1.1 * smallest),
+        key=lambda k: totals[k][1])
+
+    options = ["--codec", codec] + (["--codec-level", str(level)] if level is not None else [])
+    options += ["--row-group-rows", str(rows)] + ([] if dictionary else ["--no-dictionary"]) + ["--statistics", statistics]
+    print("Suggested merge options:", " ".join(options))
+
+
+# Benchmark all formats on the first showers of a merged simulation, the files are
+# written next to it so the disk is the same as for the merged outputs
+def benchmark(output_dir, n_showers, codecs, row_groups, repeats):
+    results = []
+    with tempfile.TemporaryDirectory(dir=output_dir + "/merged", prefix=".benchmark") as tmp:
+        for dir in mo.output_types:
+            table = sample(output_dir, dir, n_showers)
+            print("Benchmarking ", dir, " (", table.num_rows, " rows)", sep="")
+            for format in formats(codecs, row_groups):
+                results.append(measure(table, tmp + "/" + mo.output_types[dir] + ".parquet", dir, format, repeats))
+
+    csv.write_csv(pa.Table.from_pylist(results), output_dir + "/merged/" + RESULTS)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark parquet write settings on a merged simulation")
+    parser.add_argument("sim_name", help="simulation name (directory in output/), merged with merge_outputs.py")
+    parser.add_argument("--showers", type=int, default=100, help="showers of the sample (default: 100)")
+    parser.add_argument("--codecs", default="snappy,lz4,zstd:1,zstd:3,zstd:9",
+        help="comma-separated codecs with optional level (default: snappy,lz4,zstd:1,zstd:3,zstd:9)")
+    parser.add_argument("--row-groups", default="16384,65536,262144,1048576",
+        help="comma-separated rows per row group (default: 16384,65536,262144,1048576)")
+    parser.add_argument("--repeats", type=int, default=3, help="reads per pattern, the fastest counts (default: 3)")
+    args = parser.parse_args()
+
+    output_dir = "output/" + args.sim_name
+    results = benchmark(output_dir, args.showers, args.codecs.split(","),
+        [int(x) for x in args.row_groups.split(",")], args.repeats)
+    report(results)
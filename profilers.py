@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+# Profiler wrappers of C8 runs: callgrind, perf record, perf stat and /usr/bin/time,
+# their outputs are normalised into one profile.json per run
+
+import json
+import os
+import re
+import shutil
+import subprocess
+
+
+# Normalised profile written into the run directory
+PROFILE = "profile.json"
+
+# Number of costliest functions kept in the profile
+TOP_FUNCTIONS = 50
+
+
+# Base class of the profilers: wraps the C8 command line and turns the raw output
+# into totals and a list of the costliest functions
+class Profiler:
+    name = None
+    # Program that has to be installed
+    tool = None
+    # Name of the raw output in the run directory
+    raw = None
+
+    @classmethod
+    def available(cls):
+        return shutil.which(cls.tool) is not None
+
+    # Command line running cmd with the raw output written to path
+    def wrap(self, cmd, path):
+        raise NotImplementedError
+
+    # Totals and functions as ({name: value}, [{function, library, cost, fraction}])
+    def parse(self, path):
+        raise NotImplementedError
+
+    # Write the normalised profile of a raw output next to it
+    def normalise(self, path):
+        totals, functions = self.parse(path)
+        functions = sorted(functions, key=lambda f: f["cost"], reverse=True)[:TOP_FUNCTIONS]
+
+        profile = {"profiler": self.name, "raw": os.path.basename(path), "totals": totals, "functions": functions}
+        with open(os.path.join(os.path.dirname(path), PROFILE), "w") as file:
+            json.dump(profile, file, indent=1)
+        return profile
+
+
+# Instruction counts with valgrind, exact but 40-60 times slower
+class CallgrindProfiler(Profiler):
+    name = "callgrind"
+    tool = "valgrind"
+    raw = "run.prof"
+
+    # e.g. '1,234,567 (12.34%)  file.cpp:func() [/path/lib.so]'
+    LINE_RE = re.compile(r"^\s*([\d,]+)\s+\(\s*([\d.]+)%\)\s+(.*?)(?:\s+\[(.*)\])?\s*$")
+    # Source file prefix of a function, '???' if unknown
+    FILE_RE = re.compile(r"^(?:\?\?\?|[^:\s]*\.\w+):(?!:)")
+
+    def wrap(self, cmd, path):
+        return ["valgrind", "--tool=callgrind", "--callgrind-out-file=" + path, "--cache-sim=no"] + cmd
+
+    def parse(self, path):
+        out = subprocess.run(["callgrind_annotate", path], capture_output=True, text=True, check=True).stdout
+
+        totals = {}
+        functions = []
+        for line in out.splitlines():
+            if "PROGRAM TOTALS" in line:
+                totals["instructions"] = int(line.split()[0].replace(",", ""))
+                continue
+            match = self.LINE_RE.match(line)
+            if match is None:
+                continue
+            cost, fraction, function, library = match.groups()
+            functions.append({"function": self.FILE_RE.sub("", function), "library": library,
+                "cost": int(cost.replace(",", "")), "fraction": float(fraction) / 100})
+
+        return totals, functions
+
+
+# Checks the kernel allows perf events of own processes
+def perf_allowed():
+    if os.geteuid() == 0:
+        return True
+    try:
+        with open("/proc/sys/kernel/perf_event_paranoid", "r") as file:
+            return int(file.read()) <= 2
+    except (OSError, ValueError):
+        return False
+
+
+# Sampled call sites with perf, a few percent overhead
+class PerfRecordProfiler(Profiler):
+    name = "perf-record"
+    tool = "perf"
+    raw = "perf.data"
+
+    # Sampling frequency in Hz
+    FREQUENCY = 499
+
+    # e.g. '  12.34%  libfoo.so  [.] func'
+    LINE_RE = re.compile(r"^\s*([\d.]+)%\s+(\S+)\s+\[.\]\s+(.*?)\s*$")
+
+    @classmethod
+    def available(cls):
+        return super().available() and perf_allowed()
+
+    def wrap(self, cmd, path):
+        return ["perf", "record", "-q", "-F", str(self.FREQUENCY), "-o", path, "--"] + cmd
+
+    def parse(self, path):
+        out = subprocess.run(["perf", "report", "-i", path, "--stdio", "-q", "--no-children", "--sort", "dso,symbol"],
+            capture_output=True, text=True, check=True).stdout
+
+        functions = []
+        for line in out.splitlines():
+            match = self.LINE_RE.match(line)
+            if match is None:
+                continue
+            fraction, library, function = match.groups()
+            functions.append({"function": function, "library": library,
+                "cost": float(fraction) / 100, "fraction": float(fraction) / 100})
+
+        return {"frequency_hz": self.FREQUENCY}, functions
+
+
+# Hardware counters of the whole run with perf, no per-function costs
+class PerfStatProfiler(Profiler):
+    name = "perf-stat"
+    tool = "perf"
+    raw = "perf-stat.csv"
+
+    EVENTS = "task-clock,cycles,instructions,cache-references,cache-misses,branches,branch-misses"
+
+    @classmethod
+    def available(cls):
+        return super().available() and perf_allowed()
+
+    def wrap(self, cmd, path):
+        return ["perf", "stat", "-x", ",", "-o", path, "-e", self.EVENTS, "--"] + cmd
+
+    def parse(self, path):
+        totals = {}
+        with open(path, "r") as file:
+            for line in file:
+                fields = line.strip().split(",")
+                if len(fields) < 3 or line.startswith("#"):
+                    continue
+                try:
+                    totals[fields[2]] = float(fields[0])
+                except ValueError:
+                    # '<not counted>' or '<not supported>'
+                    continue
+
+        if totals.get("cycles") and "instructions" in totals:
+            totals["ipc"] = totals["instructions"] / totals["cycles"]
+        return totals, []
+
+
+# Resource usage of the run with GNU time, available almost everywhere
+class TimeProfiler(Profiler):
+    name = "time"
+    tool = "/usr/bin/time"
+    raw = "time.txt"
+
+    def wrap(self, cmd, path):
+        return ["/usr/bin/time", "-v", "-o", path] + cmd
+
+    def parse(self, path):
+        totals = {}
+        with open(path, "r") as file:
+            for line in file:
+                key, sep, value = line.strip().rpartition(": ")
+                if not sep:
+                    continue
+                key = re.sub(r"[^a-z0-9]+", "_", key.lower()).strip("_")
+                try:
+                    totals[key] = float(value.rstrip("%"))
+                except ValueError:
+                    # Command line and elapsed time in h:mm:ss
+                    totals[key] = value
+        return totals, []
+
+
+PROFILERS = {p.name: p for p in (CallgrindProfiler, PerfRecordProfiler, PerfStatProfiler, TimeProfiler)}
+
+
+# Profiler selected on the command line, 'auto' takes perf record if the kernel
+# allows it and falls back to /usr/bin/time. Returns None if it is not installed.
+def get(name):
+    if name == "auto":
+        for candidate in ("perf-record", "time"):
+            if PROFILERS[candidate].available():
+                return PROFILERS[candidate]()
+        return None
+
+    profiler = PROFILERS[name]
+    return profiler() if profiler.available() else None
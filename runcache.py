@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+# Content-addressed store of run outputs, keyed on everything that determines the
+# result of a run: C8 command line, seed, atmosphere tables, C8 binary and libraries
+
+import glob
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+
+import scratch
+
+
+# Description of the inputs of a stored run, kept next to its outputs
+KEY_FILE = "cache.json"
+
+# Digests of large files (binary, libraries) by size and modification time
+DIGESTS = "digests.json"
+
+
+# Shared libraries the binary is linked against, as resolved by ldd
+def libraries(binary):
+    try:
+        out = subprocess.run(["ldd", binary], capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return []
+
+    libs = []
+    for line in out.splitlines():
+        path = line.split("=>")[-1].split("(")[0].strip()
+        if os.path.isabs(path) and os.path.isfile(path):
+            libs.append(os.path.realpath(path))
+    return sorted(set(libs))
+
+
+class RunCache:
+    def __init__(self, store, binary, tables=()):
+        self.store = store
+        self.binary = binary
+        # Glob patterns of atmosphere tables read by C8
+        self.tables = list(tables)
+        self.env = None
+
+    # Digests of the binary, its libraries and the atmosphere tables, computed once
+    def environment(self):
+        if self.env is not None:
+            return self.env
+
+        os.makedirs(self.store, exist_ok=True)
+        path = os.path.join(self.store, DIGESTS)
+        known = {}
+        if os.path.isfile(path):
+            with open(path, "r") as file:
+                known = json.load(file)
+
+        files = [self.binary] + libraries(self.binary)
+        for pattern in self.tables:
+            files += sorted(glob.glob(pattern))
+
+        self.env = {}
+        for f in files:
+            if not os.path.isfile(f):
+                self.env[f] = None
+                continue
+            st = os.stat(f)
+            stamp = [st.st_size, st.st_mtime_ns]
+            if f not in known or known[f][:2] != stamp:
+                known[f] = stamp + [scratch.sha256(f)]
+            self.env[f] = known[f][2]
+
+        with open(path + ".tmp", "w") as file:
+            json.dump(known, file, indent=1)
+        os.replace(path + ".tmp", path)
+
+        return self.env
+
+    # Inputs of a run, the command line must not contain the output directory
+    def inputs(self, job, command):
+        return {"command": command, "seed": job.seed, "environment": self.environment()}
+
+    def key(self, job, command):
+        text = json.dumps(self.inputs(job, command), sort_keys=True)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.store, key[:2], key)
+
+    # Store holds a complete output for the key
+    def has(self, key):
+        return os.path.isfile(os.path.join(self.path(key), "summary.yaml"))
+
+    # Key the run output links to, None if it is not a link into the store
+    def linked(self, job):
+        if not os.path.islink(job.run_output):
+            return None
+        return os.path.basename(os.readlink(job.run_output))
+
+    # Run output links to an entry of different inputs, e.g. from before a rebuild of C8
+    def is_stale(self, job, command):
+        key = self.linked(job)
+        return key is not None and key != self.key(job, command)
+
+    # Point the run output to the stored output of the key
+    def link(self, job, key):
+        os.makedirs(job.sim_output, exist_ok=True)
+        if os.path.islink(job.run_output):
+            os.unlink(job.run_output)
+        elif os.path.isdir(job.run_output):
+            shutil.rmtree(job.run_output)
+        os.symlink(os.path.relpath(self.path(key), job.sim_output), job.run_output)
+
+    # Move a finished run output into the store and replace it by a link
+    def add(self, job, command, key):
+        target = self.path(key)
+        if not os.path.isdir(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(os.path.join(job.run_output, KEY_FILE), "w") as file:
+                json.dump(self.inputs(job, command), file, indent=1)
+            os.rename(job.run_output, target)
+        self.link(job, key)
@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+# SQLite database of the summaries of all runs of all simulations, with the
+# configuration parsed from the simulation name, for runtime queries across
+# simulations without merging them again
+
+import argparse
+import json
+import os
+import sqlite3
+
+import costmodel as cm
+import metrics
+
+
+# Database in the output directory
+DATABASE = "runtimes.db"
+
+# One row per run with all fields of its summary.yaml as JSON, e.g. queried with
+# json_extract(summary, '$.field'). Size and modification time of the summary
+# file tell which runs changed since the last update.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    sim TEXT NOT NULL,
+    run INTEGER NOT NULL,
+    pdg INTEGER,
+    energy REAL,
+    inj REAL,
+    zenith REAL,
+    suffix TEXT,
+    showers INTEGER,
+    runtime REAL,
+    summary TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    PRIMARY KEY (sim, run)
+);
+CREATE INDEX IF NOT EXISTS runs_config ON runs (pdg, energy, inj, zenith, suffix);
+CREATE VIEW IF NOT EXISTS configs AS
+    SELECT sim, pdg, energy, inj, zenith, suffix, COUNT(*) AS runs, SUM(showers) AS showers,
+        SUM(runtime) AS runtime, SUM(runtime) / SUM(showers) AS runtime_per_shower
+    FROM runs GROUP BY sim;
+"""
+
+
+# Number from a summary field, None if it is missing or not a number
+def number(value, type):
+    try:
+        return type(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class RuntimeDB:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    # Update the runs of a simulation from their summary files, only summaries
+    # that changed are read. Returns the number of runs read.
+    def update(self, sim_output):
+        sim = os.path.basename(os.path.normpath(sim_output))
+        params = cm.parse_name(sim) or {}
+        known = {row["run"]: (row["size"], row["mtime"])
+            for row in self.conn.execute("SELECT run, size, mtime FROM runs WHERE sim = ?", (sim,))}
+
+        rows = []
+        present = set()
+        for name in os.listdir(sim_output):
+            path = os.path.join(sim_output, name, "summary.yaml")
+            if not name.startswith("run_") or not name[4:].isdigit() or not os.path.isfile(path):
+                continue
+            run = int(name[4:])
+            present.add(run)
+
+            st = os.stat(path)
+            if known.get(run) == (st.st_size, st.st_mtime_ns):
+                continue
+            try:
+                summary = cm.read_summary(path)
+            except (OSError, ValueError) as error:
+                print("  - skipping ", sim, "/", name, ": ", error, sep="")
+                continue
+            rows.append((sim, run, params.get("pdg"), params.get("energy"), params.get("inj"), params.get("zenith"),
+                params.get("suffix"), number(summary.get("showers"), int), number(summary.get("runtime"), float),
+                json.dumps(summary, default=str), st.st_size, st.st_mtime_ns))
+
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.executemany("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.conn.executemany("DELETE FROM runs WHERE sim = ? AND run = ?",
+                [(sim, run) for run in known if run not in present])
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+        return len(rows)
+
+    # Runtime per shower of each configuration, ordered by primary and energy
+    def energy_scan(self, pdg=None, suffix=None):
+        return self.conn.execute("""
+            SELECT pdg, energy, inj, zenith, suffix, runs, showers, runtime_per_shower FROM configs
+            WHERE pdg IS NOT NULL AND (? IS NULL OR pdg = ?) AND (? IS NULL OR suffix = ?)
+            ORDER BY pdg, energy, zenith, inj, suffix""", (pdg, pdg, suffix, suffix)).fetchall()
+
+    # Runtime per shower of two variants of the same configurations and their ratio
+    def compare(self, a, b):
+        return self.conn.execute("""
+            SELECT a.pdg, a.energy, a.inj, a.zenith, a.runtime_per_shower AS a, b.runtime_per_shower AS b,
+                b.runtime_per_shower / a.runtime_per_shower AS ratio
+            FROM configs a JOIN configs b USING (pdg, energy, inj, zenith)
+            WHERE a.suffix = ? AND b.suffix = ?
+            ORDER BY a.pdg, a.energy, a.zenith, a.inj""", (a, b)).fetchall()
+
+
+if __name__ == "__main__":
+    # Only for the command line, validate imports merge_outputs, which imports this module
+    import validate
+
+    parser = argparse.ArgumentParser(description="Runtimes of all runs of all simulations in output/runtimes.db")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("update", help="read the summaries of changed runs into the database")
+    p.add_argument("sim_names", nargs="*", metavar="sim_name", help="only these simulations (default: all in output/)")
+
+    p = sub.add_parser("energy", help="runtime per shower over energy of each configuration")
+    p.add_argument("--pdg", type=int, default=None, help="only this primary")
+    p.add_argument("--suffix", default=None, help="only this variant")
+
+    p = sub.add_parser("compare", help="runtime per shower of two variants of the same configurations")
+    p.add_argument("a", help="suffix of the reference variant")
+    p.add_argument("b", help="suffix of the compared variant")
+    args = parser.parse_args()
+
+    db = RuntimeDB(os.path.join("output", DATABASE))
+
+    if args.command == "update":
+        for name in args.sim_names or validate.simulations("output"):
+            n = db.update(os.path.join("output", name))
+            if n:
+                print("  - ", name, ": ", n, " run(s) updated", sep="")
+
+    elif args.command == "energy":
+        print("{:>6s} {:>10s} {:>8s} {:>6s} {:20s} {:>5s} {:>8s} {:>12s}".format(
+            "pdg", "energy", "inj", "zenith", "suffix", "runs", "showers", "s/shower"))
+        for row in db.energy_scan(args.pdg, args.suffix):
+            print("{:6d} {:10g} {:8g} {:6g} {:20s} {:5d} {:>8s} {:>12s}".format(row["pdg"], row["energy"], row["inj"],
+                row["zenith"], row["suffix"], row["runs"], metrics.format_optional(row["showers"], "{:d}".format),
+                metrics.format_optional(row["runtime_per_shower"], "{:.3g}".format)))
+
+    elif args.command == "compare":
+        print("{:>6s} {:>10s} {:>8s} {:>6s} {:>12s} {:>12s} {:>8s}".format(
+            "pdg", "energy", "inj", "zenith", args.a[:12], args.b[:12], "ratio"))
+        for row in db.compare(args.a, args.b):
+            print("{:6d} {:10g} {:8g} {:6g} {:>12s} {:>12s} {:>8s}".format(row["pdg"], row["energy"], row["inj"],
+                row["zenith"], metrics.format_optional(row["a"], "{:.3g}".format),
+                metrics.format_optional(row["b"], "{:.3g}".format), metrics.format_optional(row["ratio"], "{:.3f}".format)))
+
+    db.close()
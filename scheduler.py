@@ -0,0 +1,1063 @@
+#!/usr/bin/python3
+# Event-driven scheduler for running Corsika8 simulations
+
+import argparse
+import asyncio
+import math
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from typing import NamedTuple
+
+import adaptive
+import autotune as at
+import campaign as cp
+import costmodel as cm
+import executors
+import ledger as lg
+import metrics
+import profilers
+import runcache
+import scratch
+import seeds as sd
+import telemetry
+import validate
+
+
+# Build type of the C8 installation
+BUILD = "release"
+
+# Main directory with the Corsika project
+MAIN_DIR = os.path.join(os.getcwd(), "..")
+# Script entering the C8 environment
+ENV_SCRIPT = os.path.join(MAIN_DIR, "source.sh")
+# C8 executable
+C8_EXEC = os.path.join(MAIN_DIR, "corsika", "install", BUILD, "bin", "c8_air_shower")
+# Wrapper recording resource telemetry of each run
+TELEMETRY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "telemetry.py")
+# Output directory
+OUTPUT_DIR = os.path.join(os.getcwd(), "output")
+# Ledger with the state of all runs in the output directory
+LEDGER = os.path.join(OUTPUT_DIR, "jobs.db")
+# Default root of the per-run working directories
+WORK_DIR = os.path.join(OUTPUT_DIR, ".work")
+# Concurrency and pinning settings found by the tune subcommand
+TUNING = os.path.join(OUTPUT_DIR, "tuning.json")
+# Registry of seed sets shared by simulations of the same showers
+SEEDS = os.path.join(OUTPUT_DIR, "seeds.db")
+# Throughput and progress metrics in the Prometheus textfile format
+METRICS = os.path.join(OUTPUT_DIR, "metrics.prom")
+# Content-addressed store of run outputs
+STORE = os.path.join(OUTPUT_DIR, ".store")
+# Atmosphere tables that runs depend on, part of the cache key
+ATMO_TABLES = [os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "atmprof_*.dat"),
+               os.path.join(MAIN_DIR, "corsika", "tests", "media", "atmprof_*.dat")]
+
+# Seconds between SIGTERM and SIGKILL when a run exceeds its wall time
+KILL_GRACE = 10
+
+
+# Class to hold one simulation configuration, values are kept as passed on the
+# command line so that the output directory names stay exactly as in run.sh
+class Config(NamedTuple):
+    suffix: str
+    pdg: str
+    energy: str
+    inj: str
+    zenith: str
+    showers: int
+    runs: int
+
+    # Simulation name, e.g. pdg2212_E1e4_inj112750_z0_opt_interp_v6
+    @property
+    def name(self):
+        return "pdg{}_E{}_inj{}_z{}_{}".format(self.pdg, self.energy, self.inj, self.zenith, self.suffix)
+
+
+# Class to hold a single C8 run of a configuration
+class Job(NamedTuple):
+    config: Config
+    run: int
+    seed: int
+
+    # Simulation output directory
+    @property
+    def sim_output(self):
+        return os.path.join(OUTPUT_DIR, self.config.name)
+
+    # Output directory of this run
+    @property
+    def run_output(self):
+        return os.path.join(self.sim_output, "run_" + str(self.run))
+
+    # Log file used while the run is active, moved to run_N/run.log afterwards
+    @property
+    def log(self):
+        return self.sim_output + "_" + str(self.run) + ".log"
+
+    # Label used in progress output
+    @property
+    def label(self):
+        return self.config.name + "/run_" + str(self.run)
+
+    # Run finished if C8 wrote its summary file
+    @property
+    def complete(self):
+        return os.path.isfile(os.path.join(self.run_output, "summary.yaml"))
+
+
+# Rebuild a job from its ledger row
+def job_from_row(row):
+    config = Config(row["suffix"], row["pdg"], row["energy"], row["inj"], row["zenith"], row["showers"], row["runs"])
+    return Job(config, row["run"], row["seed"])
+
+
+# Number of cores this process is allowed to run on
+def usable_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+# Compose the C8 command line for a run, the output directory defaults to the run output
+def c8_command(job, output=None):
+    return [C8_EXEC,
+            "-s", str(job.seed),
+            "--nevent", str(job.config.showers),
+            "--pdg", job.config.pdg,
+            "-E", job.config.energy,
+            "-f", output or job.run_output,
+            "--disable-interaction-histograms",
+            "--injection-height", job.config.inj,
+            "-z", job.config.zenith]
+
+
+# C8 command line of a run without executable and output directory, part of the cache key
+def cache_command(job):
+    cmd = c8_command(job)[1:]
+    i = cmd.index("-f")
+    return cmd[:i] + cmd[i + 2:]
+
+
+# Check whether a run has to be (re)simulated according to the ledger and its output,
+# runs linked to cached output of different inputs are always rerun
+def is_pending(job, ledger, cache=None):
+    if cache is not None and cache.is_stale(job, cache_command(job)):
+        print("  - ", job.label, ": cached output is stale, rerunning", sep="")
+        return True
+
+    row = ledger.get(job)
+
+    if row is None:
+        # Output from before the ledger existed
+        if job.complete:
+            ledger.mark_done(job)
+            return False
+        return True
+
+    if row["state"] == lg.DONE:
+        # Rerun if the output was removed since
+        return not job.complete
+
+    if row["state"] == lg.RUNNING and not ledger.is_stale(row):
+        print("  - ", job.label, " is running on ", row["host"], ", skipping", sep="")
+        return False
+
+    return True
+
+
+# List runs of a configuration that still need to be simulated and queue them in the ledger,
+# seeds are given per run index or default to the run index + 1
+def make_jobs(config, ledger, seeds=None, cache=None):
+    jobs = []
+
+    for n in range(config.runs):
+        job = Job(config, n, seeds[n] if seeds else n + 1)
+
+        if not is_pending(job, ledger, cache):
+            continue
+
+        ledger.queue(job)
+        jobs.append(job)
+
+    return jobs
+
+
+# Queue further runs of a configuration, numbered after the existing ones
+def extend_jobs(config, n_new, ledger, seeds=None):
+    config = config._replace(runs=config.runs + n_new)
+    jobs = [Job(config, n, seeds[n] if seeds else n + 1) for n in range(config.runs - n_new, config.runs)]
+
+    for job in jobs:
+        ledger.queue(job)
+
+    return jobs
+
+
+# List runs from the ledger that were queued, failed or interrupted
+def resume_jobs(ledger, sim=None):
+    jobs = []
+
+    for row in ledger.rows([lg.QUEUED, lg.FAILED, lg.RUNNING], sim):
+        if row["state"] == lg.RUNNING and not ledger.is_stale(row):
+            continue
+
+        job = job_from_row(row)
+        ledger.queue(job)
+        jobs.append(job)
+
+    return jobs
+
+
+# Class to hold one attempt of a run: working directory (None if shared),
+# C8 output directory, log file, exit code, failure message, cache key and raw
+# profiler output
+class Attempt(NamedTuple):
+    workdir: str
+    output: str
+    log: str
+    code: int
+    message: str
+    key: str = None
+    profile: str = None
+
+
+# Runs jobs with a fixed number of concurrent C8 processes, the next job is
+# started as soon as any running process exits
+class Scheduler:
+    def __init__(self, ledger, threads=None, retries=0, walltime=None, scratch_root=None, isolate=True, cpusets=None,
+                 telemetry=telemetry.INTERVAL, cache=None, profiler=None):
+        self.ledger = ledger
+        self.threads = threads or usable_cores()
+        # CPU set each worker slot pins its runs to, None for no pinning
+        self.cpusets = cpusets
+        # Number of automatic retries of a failed run
+        self.retries = retries
+        # Default wall-time budget of a run (in s) and per-configuration overrides
+        self.walltime = walltime
+        self.budgets = {}
+        # Run each C8 process in its own working directory, and write its output
+        # there too when a scratch root (e.g. /dev/shm) is given
+        self.isolate = isolate
+        self.scratch = scratch_root
+        # Sampling interval of the telemetry wrapper (in s), None to run C8 directly
+        self.telemetry = telemetry
+        # Store of run outputs, None to always simulate, and futures of runs being
+        # simulated per cache key, identical runs wait for them
+        self.cache = cache
+        self.inflight = {}
+        # Profiler wrapping each C8 process, None for no profiling
+        self.profiler = profiler
+        # Attempts of each run in this session
+        self.attempts = {}
+        self.running = {}
+        # Unfinished transfer and bookkeeping tasks
+        self.pending = set()
+        # Queue of runs to start, created by run_async
+        self.queue = None
+        # Coroutines called with (job, ok) whenever a run is finished
+        self.hooks = []
+        # Metrics file updated while running, None for no metrics
+        self.metrics_file = None
+        self.n_done = 0
+        self.n_failed = 0
+        self.n_total = 0
+        self.n_showers = 0
+
+    # Wall-time budget of a run, None for no limit
+    def budget(self, job):
+        return self.budgets.get(job.config.name, self.walltime)
+
+    # Print a single progress line
+    def progress(self):
+        print("\033[2K\rRunning: {}/{} done, {} running, {} failed".format(
+            self.n_done, self.n_total, len(self.running), self.n_failed), end="", flush=True)
+
+    # Send a signal to the process group of a run, which includes the telemetry
+    # wrapper, C8 and anything C8 started
+    def signal_run(self, proc, sig):
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    # Wait for the process, killing it when it exceeds the wall-time budget
+    async def watch(self, job, proc):
+        budget = self.budget(job)
+
+        try:
+            return await asyncio.wait_for(proc.wait(), budget), None
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # Scheduler interrupted, do not leave the run behind
+            self.signal_run(proc, signal.SIGKILL)
+            raise
+
+        message = "wall time of {:.0f} s exceeded".format(budget)
+        self.signal_run(proc, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(proc.wait(), KILL_GRACE)
+        except asyncio.TimeoutError:
+            self.signal_run(proc, signal.SIGKILL)
+
+        return await proc.wait(), message
+
+    # Command starting C8 for an attempt, wrapped to record telemetry if enabled
+    def command(self, job, output, cpus, profile=None):
+        cmd = c8_command(job, output)
+        if self.profiler is not None:
+            cmd = self.profiler.wrap(cmd, profile)
+        if self.telemetry is None:
+            return cmd
+
+        wrapper = [sys.executable, TELEMETRY, "--interval", str(self.telemetry)]
+        if cpus:
+            wrapper += ["--cpus", ",".join(str(c) for c in sorted(cpus))]
+        return wrapper + [output, "--"] + cmd
+
+    # Start a C8 process for the job and wait for it to exit
+    async def execute(self, job, cpus=None, key=None):
+        workdir = None
+        output = job.run_output
+        log_path = job.log
+
+        # A run whose directories cannot be set up fails like one that cannot be started
+        try:
+            os.makedirs(job.sim_output, exist_ok=True)
+
+            # Remove output left behind by a crashed or killed attempt, or a stale cache link
+            if os.path.islink(job.run_output):
+                os.unlink(job.run_output)
+            elif os.path.isdir(job.run_output):
+                shutil.rmtree(job.run_output)
+
+            # Working directory keeps FLUKA fort.* files and .timer.out of concurrent runs apart
+            if self.isolate:
+                workdir = scratch.workdir(self.scratch or WORK_DIR, job)
+                scratch.make_workdir(workdir)
+                if self.scratch:
+                    output = os.path.join(workdir, "output")
+                    log_path = os.path.join(workdir, "run.log")
+            log = open(log_path, "w")
+        except OSError as err:
+            self.ledger.start(job, None)
+            return Attempt(workdir, output, log_path, None, "setup failed: " + str(err), key)
+
+        # Raw profiler output, moved into the run output afterwards
+        profile = None
+        if self.profiler is not None:
+            if workdir is not None:
+                profile = os.path.join(workdir, self.profiler.raw)
+            else:
+                profile = job.sim_output + "_" + str(job.run) + "_" + self.profiler.raw
+
+        with log:
+            try:
+                proc = await asyncio.create_subprocess_exec(*self.command(job, output, cpus, profile), cwd=workdir,
+                    stdin=asyncio.subprocess.DEVNULL, stdout=log, stderr=asyncio.subprocess.STDOUT,
+                    start_new_session=True)
+            except OSError as err:
+                self.ledger.start(job, None)
+                return Attempt(workdir, output, log_path, None, str(err), key, profile)
+
+            # Pin before C8 starts its threads, they inherit the affinity (the
+            # telemetry wrapper pins itself before starting C8)
+            if cpus and self.telemetry is None:
+                try:
+                    os.sched_setaffinity(proc.pid, cpus)
+                except OSError:
+                    pass
+
+            self.ledger.start(job, proc.pid)
+            self.running[job] = proc
+            self.progress()
+            code, message = await self.watch(job, proc)
+            del self.running[job]
+
+        return Attempt(workdir, output, log_path, code, message, key, profile)
+
+    # Attempt of a run whose output is taken from the cache
+    def cached(self, job, key):
+        self.cache.link(job, key)
+        self.ledger.start(job, None)
+        return Attempt(None, job.run_output, None, 0, None, key)
+
+    # Move outputs of a finished attempt into place and record its state
+    async def collect(self, job, attempt):
+        message = attempt.message
+
+        # Move log file into the run output directory
+        if attempt.log is not None and os.path.isfile(attempt.log) and os.path.isdir(attempt.output):
+            try:
+                os.replace(attempt.log, os.path.join(attempt.output, "run.log"))
+            except OSError as err:
+                message = message or "log not moved: " + str(err)
+
+        # Move the raw profile next to the outputs and normalise it in a thread
+        if attempt.profile is not None and os.path.isfile(attempt.profile) and os.path.isdir(attempt.output):
+            raw = os.path.join(attempt.output, self.profiler.raw)
+            try:
+                os.replace(attempt.profile, raw)
+                await asyncio.to_thread(self.profiler.normalise, raw)
+            except (OSError, ValueError, subprocess.CalledProcessError) as err:
+                print("\033[2K\r  - ", job.label, ": profile not normalised: ", err, sep="")
+
+        # Transfer from scratch in a thread, the core is already free for the next run
+        if attempt.output != job.run_output and os.path.isdir(attempt.output):
+            try:
+                await asyncio.to_thread(scratch.transfer, attempt.output, job.run_output)
+            except OSError as err:
+                message = message or "transfer failed: " + str(err)
+
+        if attempt.workdir is not None:
+            shutil.rmtree(attempt.workdir, ignore_errors=True)
+            # Remove the simulation directory once its last run is gone
+            try:
+                os.rmdir(os.path.dirname(attempt.workdir))
+            except OSError:
+                pass
+
+        if attempt.code == 0 and message is None and job.complete:
+            if attempt.log is None:
+                message = "cached"
+            elif attempt.key is not None:
+                try:
+                    await asyncio.to_thread(self.cache.add, job, cache_command(job), attempt.key)
+                except OSError as err:
+                    print("\033[2K\r  - ", job.label, ": not cached: ", err, sep="")
+            self.ledger.finish(job, lg.DONE, attempt.code, message)
+            return True
+
+        if message is None:
+            message = "exit code {}".format(attempt.code) if attempt.code != 0 else "no summary.yaml written"
+        self.ledger.finish(job, lg.FAILED, attempt.code, message)
+        print("\033[2K\r  - ", job.label, ": ", message, sep="")
+
+        return False
+
+    # Finish an attempt, then retry the run or count it as done
+    async def complete(self, job, attempt, queue):
+        # Requeue before marking the job as done so the queue never looks empty
+        try:
+            ok = await self.collect(job, attempt)
+            self.attempts[job] = self.attempts.get(job, 0) + 1
+
+            if not ok and self.attempts[job] <= self.retries:
+                # Put the run back at the end of the queue
+                print("\033[2K\r  - ", job.label, ": retrying", sep="")
+                self.ledger.queue(job)
+                queue.put_nowait(job)
+                return
+
+            self.n_done += 1
+            # Cached runs are done but not simulated, they count no showers
+            if ok and attempt.log is not None:
+                self.n_showers += job.config.showers
+            elif not ok:
+                self.n_failed += 1
+            self.progress()
+
+            for hook in self.hooks:
+                await hook(job, ok)
+        finally:
+            # Identical runs waiting for this one can take its output now
+            future = self.inflight.pop(attempt.key, None) if attempt.log is not None else None
+            if future is not None:
+                future.set_result(None)
+            queue.task_done()
+
+    # Wait for an identical run being simulated, then take its output from the
+    # cache or simulate the run after all if it failed
+    async def follow(self, job, key, queue):
+        await asyncio.shield(self.inflight[key])
+
+        if self.cache.has(key):
+            try:
+                attempt = self.cached(job, key)
+            except OSError as err:
+                self.ledger.start(job, None)
+                attempt = Attempt(None, job.run_output, job.log, None, str(err), key)
+            await self.complete(job, attempt, queue)
+        else:
+            queue.put_nowait(job)
+            queue.task_done()
+
+    # Keep track of a bookkeeping task until it is done
+    def track(self, coro):
+        task = asyncio.create_task(coro)
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    # Take jobs from the queue until cancelled, slot selects the CPU set to pin to
+    async def worker(self, slot, queue):
+        cpus = self.cpusets[slot] if self.cpusets else None
+
+        while True:
+            job = await queue.get()
+
+            key = None
+            try:
+                key = self.cache.key(job, cache_command(job)) if self.cache is not None else None
+                if key in self.inflight:
+                    self.track(self.follow(job, key, queue))
+                    continue
+
+                if key is not None and self.cache.has(key):
+                    attempt = self.cached(job, key)
+                else:
+                    if key is not None:
+                        self.inflight[key] = asyncio.get_running_loop().create_future()
+                    attempt = await self.execute(job, cpus, key)
+            except OSError as err:
+                # Fail the run and keep the worker, runs left in the queue would wait forever.
+                # The log is set so identical runs waiting for this one are woken up.
+                self.ledger.start(job, None)
+                attempt = Attempt(None, job.run_output, job.log, None, str(err), key)
+            except BaseException:
+                queue.task_done()
+                raise
+
+            self.track(self.complete(job, attempt, queue))
+
+    # Add jobs to a running scheduler, e.g. from a completion hook
+    async def add_jobs(self, jobs):
+        for job in jobs:
+            self.queue.put_nowait(job)
+        self.n_total += len(jobs)
+
+    # Run all jobs and return the number of failed ones
+    async def run_async(self, jobs):
+        t_start = time.time()
+
+        queue = self.queue = asyncio.Queue()
+        for job in jobs:
+            queue.put_nowait(job)
+        self.n_total += len(jobs)
+
+        workers = [asyncio.create_task(self.worker(slot, queue)) for slot in range(self.threads)]
+        if self.metrics_file is not None:
+            workers.append(asyncio.create_task(metrics.export(self.ledger, self.metrics_file, self.threads)))
+        await queue.join()
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+        # Newline after progress line
+        print()
+
+        # Throughput, allows comparing e.g. runs with and without scratch directories
+        wall = time.time() - t_start
+        if self.n_showers and wall > 0:
+            print("Simulated {} showers in {:.1f} s: {:.1f} showers/hour".format(
+                self.n_showers, wall, self.n_showers / wall * 3600))
+
+        return self.n_failed
+
+    def run(self, jobs):
+        return asyncio.run(self.run_async(jobs))
+
+
+# Print configuration in the same form as run.sh
+def print_config(config, threads):
+    print("Shower simulation configuration:")
+    print(" - PDG     : ", config.pdg)
+    print(" - Energy  : ", config.energy)
+    print(" - Inj. H  : ", config.inj)
+    print(" - Zenith  : ", config.zenith)
+    print(" - Showers : ", config.showers)
+    print(" - Runs    : ", config.runs)
+    print(" - Suffix  : ", config.suffix)
+    print(" - Output  : ", os.path.join(OUTPUT_DIR, config.name))
+    print(" - Threads : ", threads)
+
+
+# Split a total number of showers of a configuration into runs, the shard size is
+# taken from the seed set if it is known already, so that all its simulations match
+def shard(config, total, threads, registry, seed_set):
+    showers = registry.showers(seed_set)
+    if showers is None:
+        showers = cm.shard_size(cm.CostModel.from_output(OUTPUT_DIR), config, total, threads)
+
+    return config._replace(showers=showers, runs=math.ceil(total / showers))
+
+
+# Run cache from the common command line options, None if disabled. Profiled runs
+# are always simulated, a cached output has no profile.
+def make_cache(args):
+    if args.no_cache or args.profiler:
+        return None
+    return runcache.RunCache(STORE, C8_EXEC, ATMO_TABLES)
+
+
+# Profiler from the common command line options, exits if it is not installed
+def make_profiler(args):
+    if not args.profiler:
+        return None
+
+    profiler = profilers.get(args.profiler)
+    if profiler is None:
+        sys.exit("Profiler '" + args.profiler + "' is not available on this host")
+    print("Profiling runs with", profiler.name)
+    return profiler
+
+
+# Order jobs longest-first by predicted runtime and print the forecast
+def plan(jobs, scheduler):
+    model = cm.CostModel.from_output(OUTPUT_DIR)
+    jobs = cm.longest_first(jobs, model)
+    # Batch executors without a task limit run everything at once
+    cm.print_forecast(jobs, model, scheduler.threads or len(jobs))
+    return jobs
+
+
+# Create the scheduler from the common command line options, concurrency and
+# pinning not given on the command line are taken from the tuned setting of this host
+def make_scheduler(args):
+    threads = args.threads
+    pinning = args.pinning
+
+    setting = at.host_setting(TUNING)
+    if setting is not None and threads is None and pinning is None:
+        threads = setting["threads"]
+        pinning = setting["pinning"]
+        print("Using tuned setting: {} threads, pinning '{}'".format(threads, pinning))
+
+    threads = threads or usable_cores()
+    cpusets = at.cpusets(pinning or "none", threads)
+
+    ledger = lg.Ledger(args.ledger)
+    return Scheduler(ledger, threads, args.retries, args.walltime, args.scratch, not args.no_isolation, cpusets,
+        None if args.no_telemetry else args.telemetry_interval, make_cache(args), make_profiler(args))
+
+
+# Create the local scheduler or a batch executor as selected on the command line
+def make_runner(args):
+    if args.executor == "local":
+        runner = make_scheduler(args)
+        runner.metrics_file = None if args.no_metrics else args.metrics
+        return runner
+
+    # Options forwarded to 'scheduler.py exec' in each array task
+    task_args = []
+    if args.scratch:
+        task_args += ["--scratch", args.scratch]
+    if args.no_isolation:
+        task_args.append("--no-isolation")
+    if args.no_telemetry:
+        task_args.append("--no-telemetry")
+    else:
+        task_args += ["--telemetry-interval", str(args.telemetry_interval)]
+    if args.walltime:
+        task_args += ["--walltime", str(args.walltime)]
+    if args.no_cache:
+        task_args.append("--no-cache")
+    if args.profiler:
+        task_args += ["--profiler", args.profiler]
+
+    ledger = lg.Ledger(args.ledger)
+    executor = executors.EXECUTORS[args.executor]
+    runner = executor(ledger, os.path.abspath(ENV_SCRIPT), args.retries, args.threads, task_args, args.batch_option)
+    runner.metrics_file = None if args.no_metrics else args.metrics
+    return runner
+
+
+def cmd_run(args):
+    config = Config(args.suffix, args.pdg, args.energy, args.inj, args.zenith, args.showers, args.runs)
+    scheduler = make_runner(args)
+
+    # Seeds from the registry when sharding or when a seed set is given
+    seeds = None
+    if args.shard or args.seed_set:
+        registry = sd.SeedRegistry(SEEDS)
+        seed_set = args.seed_set or sd.default_set(config)
+        if args.shard:
+            config = shard(config, args.showers * args.runs, scheduler.threads or usable_cores(), registry, seed_set)
+        try:
+            seeds = registry.reserve(seed_set, config.showers, config.runs)
+        except ValueError as error:
+            print("Cannot use ", error, ", give --showers of the seed set or another --seed-set", sep="")
+            return 1
+        finally:
+            registry.close()
+        print("Using seed set '", seed_set, "': seeds ", seeds[0], "-", seeds[-1], sep="")
+    print_config(config, scheduler.threads)
+
+    jobs = make_jobs(config, scheduler.ledger, seeds, make_cache(args))
+    print("Runs to simulate:", len(jobs))
+    jobs = plan(jobs, scheduler)
+    if args.dry_run:
+        return 0
+
+    # Ingest each run as soon as it finished and merge after the last one
+    merger = None
+    if args.merge:
+        merger = cp.Merger(OUTPUT_DIR, options=args.merge_option)
+        merger.add(config, len(jobs))
+        scheduler.hooks.append(merger)
+
+    async def run_and_merge():
+        n_failed = await scheduler.run_async(jobs)
+        if merger is not None:
+            await merger.merge_finished()
+        return n_failed
+
+    n_failed = asyncio.run(run_and_merge())
+    print("All done")
+
+    return 1 if n_failed else 0
+
+
+# Run all configurations of a campaign file in one job pool, merging each
+# configuration as soon as its last run finished
+def cmd_campaign(args):
+    campaign = cp.load(args.file)
+    runner = make_runner(args)
+    merger = cp.Merger(OUTPUT_DIR, args.merge_jobs, not args.no_ingest, args.merge_option)
+    registry = sd.SeedRegistry(SEEDS)
+    cache = make_cache(args)
+    # Seed set of each sharded configuration
+    seed_sets = {}
+
+    # Further runs for adaptive stopping, with seeds of the seed set if there is one
+    def extend(config, n_new):
+        seeds = None
+        if config.name in seed_sets:
+            seeds = registry.reserve(seed_sets[config.name], config.showers, config.runs + n_new)
+        return extend_jobs(config, n_new, runner.ledger, seeds)
+
+    controller = None
+    if args.adaptive:
+        controller = adaptive.Controller(runner, merger, extend, args.precision, args.max_runs,
+            runner.threads or usable_cores())
+
+    jobs = []
+    n_configs = 0
+    for c in cp.expand(campaign):
+        config = Config(c["suffix"], c["pdg"], c["energy"], c["inj"], c["zenith"], c["showers"], c["runs"])
+        n_configs += 1
+        if c["walltime"]:
+            runner.budgets[config.name] = c["walltime"]
+
+        if c["total_showers"] or c["seed_set"]:
+            seed_sets[config.name] = c["seed_set"] or sd.default_set(config)
+        if c["total_showers"]:
+            config = shard(config, c["total_showers"], runner.threads or usable_cores(), registry,
+                seed_sets[config.name])
+
+        # Include runs added by earlier adaptive sessions
+        if controller is not None:
+            runs = [row["run"] for row in runner.ledger.rows(sim=config.name)]
+            config = config._replace(runs=max(runs + [config.runs - 1]) + 1)
+
+        seeds = None
+        if config.name in seed_sets:
+            try:
+                seeds = registry.reserve(seed_sets[config.name], config.showers, config.runs)
+            except ValueError as error:
+                print("Cannot use ", error, ", give showers of the seed set or another seed_set in ", args.file, sep="")
+                registry.close()
+                return 1
+
+        config_jobs = make_jobs(config, runner.ledger, seeds, cache)
+        merger.add(config, len(config_jobs))
+        if controller is not None:
+            controller.add(config, len(config_jobs), c["precision"], c["max_runs"])
+        jobs += config_jobs
+        print("  - {:50s} {:4d}/{} run(s) to simulate".format(config.name, len(config_jobs), config.runs))
+
+    print("Campaign '", campaign.get("name", args.file), "': ", n_configs, " configuration(s), ", len(jobs),
+        " run(s) to simulate on ", runner.threads or "unlimited", " threads", sep="")
+    jobs = plan(jobs, runner)
+    if args.dry_run:
+        return 0
+
+    # Adaptive stopping has to see finished runs before the merger does
+    if controller is not None:
+        runner.hooks.append(controller)
+    if not args.no_merge:
+        runner.hooks.append(merger)
+
+    async def run_campaign():
+        run_jobs = jobs
+        if controller is not None:
+            run_jobs = jobs + await controller.initial_jobs()
+        n_failed = await runner.run_async(run_jobs)
+        if not args.no_merge:
+            await merger.merge_finished()
+        return n_failed
+
+    n_failed = asyncio.run(run_campaign())
+
+    if not args.no_merge and not args.no_analysis:
+        cp.run_analysis(campaign)
+    print("All done")
+
+    return 1 if n_failed else 0
+
+
+# Run a single run in this process, used by array tasks of the batch executors
+def cmd_exec(args):
+    config = Config(args.suffix, args.pdg, args.energy, args.inj, args.zenith, args.showers, args.runs)
+    job = Job(config, args.run, args.seed if args.seed is not None else args.run + 1)
+
+    # The submitting host keeps the real ledger, the state here is only needed for this run
+    ledger = lg.Ledger(":memory:")
+    scheduler = Scheduler(ledger, 1, 0, args.walltime, args.scratch, not args.no_isolation, None,
+        None if args.no_telemetry else args.telemetry_interval, make_cache(args), make_profiler(args))
+
+    print("Running", job.label, "with seed", job.seed, "on", ledger.host)
+    n_failed = scheduler.run([job])
+
+    return 1 if n_failed else 0
+
+
+def cmd_resume(args):
+    scheduler = make_runner(args)
+
+    jobs = resume_jobs(scheduler.ledger, args.sim)
+    print("Resuming", len(jobs), "unfinished run(s) from", args.ledger)
+    jobs = plan(jobs, scheduler)
+    if args.dry_run:
+        return 0
+
+    n_failed = scheduler.run(jobs)
+    print("All done")
+
+    return 1 if n_failed else 0
+
+
+# Print progress and throughput of all simulations in the ledger
+def cmd_status(args):
+    if not os.path.isfile(args.ledger):
+        print("No ledger at", args.ledger)
+        return 1
+
+    ledger = lg.Ledger(args.ledger)
+    metrics.print_status(*metrics.collect(ledger, args.sim))
+    ledger.close()
+
+    return 0
+
+
+# Check run and merged outputs from their parquet footers and summaries
+def cmd_validate(args):
+    if not os.path.isdir(args.output):
+        print("No outputs at", args.output)
+        return 1
+
+    names = [args.sim] if args.sim else None
+    return 1 if validate.validate(args.output, names, args.jobs) else 0
+
+
+# Measure showers/hour of a short fixed-seed workload for each concurrency level
+# and pinning mode, and save the best setting for this host
+def cmd_tune(args):
+    levels = [int(x) for x in args.levels.split(",")] if args.levels else at.default_levels()
+    modes = args.pinning.split(",")
+    for mode in modes:
+        if mode not in at.PINNING:
+            print("Unknown pinning mode '", mode, "'", sep="")
+            return 1
+
+    print("Tuning with", len(at.physical_cores()), "physical cores,", len(at.allowed_cpus()),
+        "logical CPUs and", len(at.numa_nodes()), "NUMA node(s)")
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        ledger = lg.Ledger(os.path.join(tmp, "tune.db"))
+
+        for mode in modes:
+            for threads in levels:
+                print("Concurrency {}, pinning '{}':".format(threads, mode))
+
+                # Same seeds for every setting, so all of them simulate the same showers
+                config = Config("tune_j{}_{}".format(threads, mode), args.pdg, args.energy, args.inj,
+                    args.zenith, args.showers, threads * args.waves)
+                sim_output = os.path.join(OUTPUT_DIR, config.name)
+                if os.path.isdir(sim_output):
+                    shutil.rmtree(sim_output)
+
+                scheduler = Scheduler(ledger, threads, 0, None, args.scratch, True, at.cpusets(mode, threads))
+                t_start = time.time()
+                scheduler.run(make_jobs(config, ledger))
+                wall = time.time() - t_start
+                shutil.rmtree(sim_output, ignore_errors=True)
+
+                results.append({"threads": threads, "pinning": mode, "failed": scheduler.n_failed,
+                    "showers_per_hour": scheduler.n_showers / wall * 3600})
+
+        ledger.close()
+
+    print("Results:")
+    for r in results:
+        print(" - threads {:4d}, pinning {:5s}: {:10.1f} showers/hour{}".format(r["threads"], r["pinning"],
+            r["showers_per_hour"], ", {} failed".format(r["failed"]) if r["failed"] else ""))
+
+    # Settings whose runs failed measured a broken setup, not the throughput
+    valid = [r for r in results if not r["failed"] and r["showers_per_hour"] > 0]
+    if not valid:
+        print("No setting simulated all its showers, ", TUNING, " is left unchanged", sep="")
+        return 1
+
+    best = max(valid, key=lambda r: r["showers_per_hour"])
+    at.save_setting(TUNING, {"threads": best["threads"], "pinning": best["pinning"],
+        "showers_per_hour": best["showers_per_hour"], "time": time.strftime("%Y-%m-%d %H:%M"),
+        "results": results})
+    print("Best: {} threads, pinning '{}', saved to {}".format(best["threads"], best["pinning"], TUNING))
+
+    return 0
+
+
+# Options of a single run, shared by all subcommands that run simulations
+def add_exec_options(p):
+    p.add_argument("--walltime", type=float, default=None,
+        help="wall-time budget of a run in seconds, longer runs are killed (default: no limit)")
+    p.add_argument("--scratch", default=None,
+        help="run C8 in scratch directories below this path (e.g. /dev/shm), "
+        "outputs are transferred to output/ with checksums afterwards")
+    p.add_argument("--no-isolation", action="store_true",
+        help="run all C8 processes in the current directory as the old run.sh did")
+    p.add_argument("--telemetry-interval", type=float, default=telemetry.INTERVAL,
+        help="sampling interval of RSS and CPU usage in seconds (default: 1)")
+    p.add_argument("--no-telemetry", action="store_true",
+        help="run C8 directly without recording resource telemetry")
+    p.add_argument("--no-cache", action="store_true",
+        help="always simulate, without reusing or storing outputs in the run cache")
+    p.add_argument("--profiler", choices=["auto"] + list(profilers.PROFILERS), default=None,
+        help="wrap C8 in a profiler and write run_N/profile.json, 'auto' uses perf record if "
+        "possible and /usr/bin/time otherwise (default: no profiling)")
+
+
+# Options of the merges started by the scheduler, merge_outputs.py keeps them for
+# later merges of the simulation
+def add_merge_options(p):
+    p.add_argument("--merge-option", action="append", default=[],
+        help="extra option of merge_outputs.py, e.g. '--compact' or '--dataset' (repeatable)")
+
+
+# Options shared by all subcommands that schedule runs
+def add_run_options(p):
+    p.add_argument("-j", "--threads", type=int, default=None,
+        help="number of concurrent runs (default: tuned setting, or cores in the CPU affinity mask)")
+    p.add_argument("--pinning", choices=at.PINNING, default=None,
+        help="pin runs to physical cores or NUMA nodes (default: tuned setting, or none)")
+    p.add_argument("--retries", type=int, default=2,
+        help="number of automatic retries of a failed run (default: 2)")
+    p.add_argument("--ledger", default=LEDGER,
+        help="SQLite ledger with the state of all runs (default: output/jobs.db)")
+    p.add_argument("--executor", choices=["local"] + list(executors.EXECUTORS), default="local",
+        help="run locally or submit array jobs to a batch system (default: local)")
+    p.add_argument("--batch-option", action="append", default=[],
+        help="extra batch system option, e.g. '--partition=long' for slurm (repeatable)")
+    p.add_argument("-n", "--dry-run", action="store_true",
+        help="only print the runs and the runtime forecast")
+    p.add_argument("--metrics", default=METRICS,
+        help="Prometheus textfile with throughput and progress metrics, e.g. in the textfile "
+        "directory of node-exporter (default: output/metrics.prom)")
+    p.add_argument("--no-metrics", action="store_true", help="do not write the metrics file")
+    add_exec_options(p)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Scheduler for Corsika8 simulations")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    # Run a single configuration, arguments follow run.sh
+    p = sub.add_parser("run", help="run simulations of one configuration")
+    p.add_argument("suffix", help="simulation name suffix")
+    p.add_argument("pdg", help="primary particle PDG code")
+    p.add_argument("energy", help="primary particle energy (in GeV)")
+    p.add_argument("inj", help="injection height (in m)")
+    p.add_argument("zenith", help="zenith angle (in deg)")
+    p.add_argument("showers", type=int, help="number of showers in each run")
+    p.add_argument("runs", type=int, help="number of runs")
+    p.add_argument("--shard", action="store_true",
+        help="split showers x runs into runs sized from the measured initialisation and per-shower cost")
+    p.add_argument("--seed-set", default=None,
+        help="take seeds (and the shard size) from this set of the seed registry, "
+        "implied by --shard (default set: simulation name without the suffix)")
+    p.add_argument("--merge", action="store_true",
+        help="ingest each run into the merged outputs as soon as it finished and merge after the last run")
+    add_merge_options(p)
+    add_run_options(p)
+    p.set_defaults(func=cmd_run)
+
+    # Whole campaign from a TOML or YAML file
+    p = sub.add_parser("campaign", help="run, merge and analyse all configurations of a campaign file")
+    p.add_argument("file", help="campaign file (.toml or .yaml)")
+    p.add_argument("--merge-jobs", type=int, default=1, help="number of concurrent ingests and merges (default: 1)")
+    p.add_argument("--no-merge", action="store_true", help="do not merge finished configurations")
+    add_merge_options(p)
+    p.add_argument("--no-ingest", action="store_true",
+        help="do not ingest runs as they finish, read all runs when merging")
+    p.add_argument("--no-analysis", action="store_true", help="skip the analysis steps of the campaign")
+    p.add_argument("--adaptive", action="store_true",
+        help="add runs to each configuration until its profile and energy loss medians reach the target precision")
+    p.add_argument("--precision", type=float, default=0.05,
+        help="target relative interquartile width of the medians at every X < 1030 (default: 0.05)")
+    p.add_argument("--max-runs", type=int, default=100,
+        help="maximum number of runs of a configuration with --adaptive (default: 100)")
+    add_run_options(p)
+    p.set_defaults(func=cmd_campaign)
+
+    # Single run, executed by array tasks on batch worker nodes
+    p = sub.add_parser("exec", help="run a single run of a configuration in this process")
+    p.add_argument("suffix", help="simulation name suffix")
+    p.add_argument("pdg", help="primary particle PDG code")
+    p.add_argument("energy", help="primary particle energy (in GeV)")
+    p.add_argument("inj", help="injection height (in m)")
+    p.add_argument("zenith", help="zenith angle (in deg)")
+    p.add_argument("showers", type=int, help="number of showers in each run")
+    p.add_argument("runs", type=int, help="number of runs")
+    p.add_argument("run", type=int, help="index of the run to simulate")
+    p.add_argument("--seed", type=int, default=None, help="seed of the run (default: run index + 1)")
+    add_exec_options(p)
+    p.set_defaults(func=cmd_exec)
+
+    # Rerun everything the ledger does not list as done
+    p = sub.add_parser("resume", help="rerun queued, failed and interrupted runs from the ledger")
+    p.add_argument("sim", nargs="?", default=None, help="only resume this simulation")
+    add_run_options(p)
+    p.set_defaults(func=cmd_resume)
+
+    # Progress of all simulations in the ledger
+    p = sub.add_parser("status", help="show queued/running/failed runs, throughput and ETA from the ledger")
+    p.add_argument("sim", nargs="?", default=None, help="only show this simulation")
+    p.add_argument("--ledger", default=LEDGER,
+        help="SQLite ledger with the state of all runs (default: output/jobs.db)")
+    p.set_defaults(func=cmd_status)
+
+    # Integrity of the outputs without reading their data
+    p = sub.add_parser("validate", help="check row counts, shower numbers and schemas of run and merged outputs")
+    p.add_argument("sim", nargs="?", default=None, help="only check this simulation")
+    p.add_argument("--output", default=OUTPUT_DIR, help="output directory (default: output)")
+    p.add_argument("-j", "--jobs", type=int, default=None, help="files read in parallel (default: number of CPUs)")
+    p.set_defaults(func=cmd_validate)
+
+    # Calibrate concurrency and pinning on a short fixed-seed workload
+    p = sub.add_parser("tune", help="measure throughput at several concurrency levels and pinning modes")
+    p.add_argument("--levels", default=None,
+        help="comma-separated concurrency levels (default: half and all physical cores, all logical CPUs)")
+    p.add_argument("--pinning", default=",".join(at.PINNING),
+        help="comma-separated pinning modes to try (default: none,core,numa)")
+    p.add_argument("--waves", type=int, default=2, help="runs per concurrent slot (default: 2)")
+    p.add_argument("--pdg", default="22", help="primary of the workload (default: 22)")
+    p.add_argument("--energy", default="100", help="energy of the workload in GeV (default: 100)")
+    p.add_argument("--inj", default="112750", help="injection height of the workload (default: 112750)")
+    p.add_argument("--zenith", default="0", help="zenith angle of the workload (default: 0)")
+    p.add_argument("--showers", type=int, default=1, help="showers per run (default: 1)")
+    p.add_argument("--scratch", default=None, help="scratch root as for the run subcommand")
+    p.set_defaults(func=cmd_tune)
+
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    sys.exit(args.func(args))
@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+# Per-run scratch directories and checksummed transfer of finished outputs
+
+import getpass
+import hashlib
+import os
+import shutil
+
+
+# Name of the checksum manifest written into each transferred run directory
+MANIFEST = "checksums.sha256"
+
+# Read size used for checksums
+CHUNK = 1 << 20
+
+
+# Scratch directory of a run below the given root, e.g. /dev/shm/c8-user/pdg22_E100_..._t/run_3
+def workdir(root, job):
+    return os.path.join(root, "c8-" + getpass.getuser(), job.config.name, "run_" + str(job.run))
+
+
+# Create an empty scratch directory
+def make_workdir(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    return path
+
+
+def sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Relative paths of all files below a directory
+def list_files(path):
+    files = []
+    for root, _, names in os.walk(path):
+        for name in names:
+            files.append(os.path.relpath(os.path.join(root, name), path))
+    return sorted(files)
+
+
+# Move a finished run output to its final place. Files are copied through a
+# staging directory next to the destination and verified against the checksum
+# of the source, only a complete copy is renamed to the final name. Within one
+# filesystem the directory is renamed and only the manifest is computed.
+def transfer(src, dst):
+    staging = dst + ".partial"
+    if os.path.isdir(staging):
+        shutil.rmtree(staging)
+
+    same_fs = os.stat(src).st_dev == os.stat(os.path.dirname(dst)).st_dev
+
+    if same_fs:
+        os.rename(src, staging)
+        sums = {f: sha256(os.path.join(staging, f)) for f in list_files(staging) if f != MANIFEST}
+    else:
+        sums = {}
+        for f in list_files(src):
+            if f == MANIFEST:
+                continue
+            digest = sha256(os.path.join(src, f))
+            target = os.path.join(staging, f)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(os.path.join(src, f), target)
+            if sha256(target) != digest:
+                raise IOError("checksum mismatch after copying '" + f + "'")
+            sums[f] = digest
+
+    # Manifest in the usual sha256sum format
+    with open(os.path.join(staging, MANIFEST), "w") as file:
+        for f, digest in sums.items():
+            file.write(digest + "  " + f + "\n")
+
+    os.rename(staging, dst)
+
+    if not same_fs:
+        shutil.rmtree(src)
+
+    return len(sums)
@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+# Registry of seed sets: globally unique, reproducible seeds and shard sizes shared
+# by simulations that should simulate the same showers (e.g. atmosphere variants)
+
+import os
+import sqlite3
+import time
+
+
+# First seed handed out by the registry, seeds below are used by runs with
+# seed = run index + 1 as run.sh did
+SEED_BASE = 1000001
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS seed_sets (
+    name TEXT PRIMARY KEY,
+    showers INTEGER NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS seeds (
+    seed_set TEXT NOT NULL,
+    shard INTEGER NOT NULL,
+    seed INTEGER NOT NULL UNIQUE,
+    PRIMARY KEY (seed_set, shard)
+);
+"""
+
+
+# Default seed set of a configuration: its name without the suffix, so that
+# variants differing only in the suffix share their seeds
+def default_set(config):
+    return "pdg{}_E{}_inj{}_z{}".format(config.pdg, config.energy, config.inj, config.zenith)
+
+
+class SeedRegistry:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    # Showers per shard of a seed set, None if the set is not known
+    def showers(self, name):
+        row = self.conn.execute("SELECT showers FROM seed_sets WHERE name = ?", (name,)).fetchone()
+        return None if row is None else row[0]
+
+    # Seeds of the first n shards of a seed set, creating the set and allocating
+    # seeds of new shards as needed
+    def reserve(self, name, showers, n):
+        # Exclusive while allocating, other processes may use the same registry
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            known = self.showers(name)
+            if known is None:
+                self.conn.execute("INSERT INTO seed_sets (name, showers, created) VALUES (?, ?, ?)",
+                    (name, showers, time.time()))
+            elif known != showers:
+                raise ValueError("seed set " + name + " has " + str(known) + " showers per shard, not " + str(showers))
+
+            have = self.conn.execute("SELECT COUNT(*) FROM seeds WHERE seed_set = ?", (name,)).fetchone()[0]
+            if have < n:
+                last = self.conn.execute("SELECT MAX(seed) FROM seeds").fetchone()[0]
+                first = max(last + 1 if last is not None else SEED_BASE, SEED_BASE)
+                self.conn.executemany("INSERT INTO seeds (seed_set, shard, seed) VALUES (?, ?, ?)",
+                    [(name, shard, first + shard - have) for shard in range(have, n)])
+
+            rows = self.conn.execute("SELECT seed FROM seeds WHERE seed_set = ? AND shard < ? ORDER BY shard",
+                (name, n)).fetchall()
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+        return [row[0] for row in rows]
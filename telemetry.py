@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+# Resource telemetry of a single C8 run, used by scheduler.py as a wrapper:
+#   python3 telemetry.py [--interval s] [--cpus 0,1] output_dir -- c8_air_shower ...
+# Writes a getrusage/proc summary (telemetry.yaml) and a sampled RSS/CPU time
+# series (telemetry.parquet) into the run output directory after C8 exits.
+
+import argparse
+import ctypes
+import os
+import resource
+import select
+import signal
+import subprocess
+import sys
+import time
+
+
+# Output files inside the run directory
+SUMMARY = "telemetry.yaml"
+SERIES = "telemetry.parquet"
+
+# Default sampling interval (in s)
+INTERVAL = 1.0
+
+# Clock ticks per second and page size used in /proc/<pid>/stat
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+# prctl option delivering a signal to a process when its parent exits
+PR_SET_PDEATHSIG = 1
+
+
+# CPU time (in ticks) and resident set size (in bytes) of a process, None if it is gone
+def read_stat(pid):
+    try:
+        with open("/proc/" + str(pid) + "/stat", "r") as file:
+            # Fields after the command name, which may contain spaces
+            fields = file.read().rpartition(")")[2].split()
+    except OSError:
+        return None
+    return int(fields[11]) + int(fields[12]), int(fields[21]) * PAGE_SIZE
+
+
+# I/O counters of a process, empty if not readable
+def read_io(pid):
+    io = {}
+    try:
+        with open("/proc/" + str(pid) + "/io", "r") as file:
+            for line in file:
+                key, _, value = line.partition(":")
+                io[key.strip()] = int(value)
+    except (OSError, ValueError):
+        pass
+    return io
+
+
+# Wait up to timeout for the process to exit without reaping it, so that its
+# final /proc counters can still be read
+def wait_exit(pidfd, pid, timeout):
+    if pidfd is not None:
+        poll = select.poll()
+        poll.register(pidfd, select.POLLIN)
+        return bool(poll.poll(timeout * 1000))
+
+    # Fallback without pidfd support, poll in short steps
+    t_end = time.time() + timeout
+    while time.time() < t_end:
+        try:
+            if os.waitid(os.P_PID, pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None:
+                return True
+        except ChildProcessError:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+# Deliver a signal to this process when its parent exits
+def set_pdeathsig(sig=signal.SIGKILL):
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.prctl(PR_SET_PDEATHSIG, sig)
+    except (OSError, AttributeError):
+        pass
+
+
+# Send a signal to the command, unless it is already gone
+def forward(pid, sig):
+    try:
+        os.kill(pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+# Run the command, sample it until it exits and return exit code, samples, rusage and I/O counters
+def monitor(cmd, interval):
+    t_start = time.time()
+    proc = subprocess.Popen(cmd, preexec_fn=set_pdeathsig)
+
+    # Forward termination requests (e.g. from the scheduler watchdog) to C8. Not
+    # with proc.send_signal, which reaps an exited C8 before its rusage is read.
+    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(sig, lambda s, _: forward(proc.pid, s))
+
+    try:
+        pidfd = os.pidfd_open(proc.pid)
+    except (AttributeError, OSError):
+        pidfd = None
+
+    samples = []
+    last = None
+    io = {}
+
+    while True:
+        exited = wait_exit(pidfd, proc.pid, interval if samples else 0.1)
+
+        # Counters of an exited but not yet reaped process are final
+        now = time.time()
+        stat = read_stat(proc.pid)
+        io = read_io(proc.pid) or io
+        if stat is not None and not exited:
+            ticks, rss = stat
+            cpu = 0.0 if last is None else (ticks - last[1]) / CLK_TCK / (now - last[0]) * 100
+            samples.append((now - t_start, rss, cpu))
+            last = (now, ticks)
+
+        if exited:
+            break
+
+    try:
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    except ChildProcessError:
+        # Reaped elsewhere, the rusage of all children is that of C8
+        proc.wait()
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    if pidfd is not None:
+        os.close(pidfd)
+
+    return proc.returncode, time.time() - t_start, samples, usage, io
+
+
+def write_summary(path, code, wall, samples, usage, io):
+    values = {"exit_code": code,
+              "wall": round(wall, 3),
+              "utime": round(usage.ru_utime, 3),
+              "stime": round(usage.ru_stime, 3),
+              "max_rss_kb": usage.ru_maxrss,
+              "minflt": usage.ru_minflt,
+              "majflt": usage.ru_majflt,
+              "nvcsw": usage.ru_nvcsw,
+              "nivcsw": usage.ru_nivcsw,
+              "inblock": usage.ru_inblock,
+              "oublock": usage.ru_oublock,
+              "rchar": io.get("rchar", 0),
+              "wchar": io.get("wchar", 0),
+              "read_bytes": io.get("read_bytes", 0),
+              "write_bytes": io.get("write_bytes", 0),
+              "samples": len(samples)}
+
+    with open(path, "w") as file:
+        for key, value in values.items():
+            file.write(key + ": " + str(value) + "\n")
+
+
+# Compact time series: time since start (s), RSS (MiB) and CPU usage (%)
+def write_series(path, samples):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.table({"t": pa.array([s[0] for s in samples], pa.float32()),
+                      "rss": pa.array([s[1] / 2**20 for s in samples], pa.float32()),
+                      "cpu": pa.array([s[2] for s in samples], pa.float32())})
+    pq.write_table(table, path, compression="zstd")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Run a command and record its resource usage")
+    parser.add_argument("--interval", type=float, default=INTERVAL, help="sampling interval in seconds")
+    parser.add_argument("--cpus", default=None, help="comma-separated CPUs to pin the command to")
+    parser.add_argument("output", help="directory to write the telemetry files into")
+    parser.add_argument("cmd", nargs=argparse.REMAINDER, help="command to run, after '--'")
+    args = parser.parse_args(argv)
+
+    cmd = args.cmd[1:] if args.cmd[:1] == ["--"] else args.cmd
+
+    # Stop C8 if the scheduler dies, C8 itself dies with this wrapper
+    set_pdeathsig(signal.SIGTERM)
+
+    # Pin before starting the command, its threads inherit the affinity
+    if args.cpus:
+        os.sched_setaffinity(0, [int(c) for c in args.cpus.split(",")])
+
+    code, wall, samples, usage, io = monitor(cmd, args.interval)
+
+    # Output directory only exists if C8 got far enough to create it
+    if os.path.isdir(args.output):
+        write_summary(os.path.join(args.output, SUMMARY), code, wall, samples, usage, io)
+        try:
+            write_series(os.path.join(args.output, SERIES), samples)
+        except ImportError:
+            print("telemetry: pyarrow not available, no time series written", file=sys.stderr)
+
+    # Report signals the same way a shell does
+    return code if code >= 0 else 128 - code
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,115 @@
+import glob
+import os
+import shutil
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import merge_outputs as mo
+
+
+# Outputs of a run with the layout of C8, n showers with a few rows each and
+# arrival times up to t_max (in s)
+def make_run(output_dir, run, n, t_max=1e-4):
+    rng = np.random.default_rng(run)
+    run_dir = os.path.join(output_dir, "run_" + str(run))
+    shower = np.repeat(np.arange(n), 3)
+    X = np.tile([0.0, 10.0, 20.0], n)
+    tables = {
+        "energyloss": {"shower": shower, "X": X, "total": rng.random(3 * n)},
+        "profile": {"shower": shower, "X": X, "charged": rng.integers(0, 100, 3 * n),
+            "electron": rng.integers(0, 100, 3 * n), "positron": rng.integers(0, 100, 3 * n),
+            "muplus": rng.integers(0, 10, 3 * n), "muminus": rng.integers(0, 10, 3 * n)},
+        "production_profile": {"shower": shower, "X": X, "muon": rng.integers(0, 10, 3 * n)},
+        "particles": {"shower": shower, "pdg": rng.choice([11, 13, 22, 2212], 3 * n),
+            "kinetic_energy": 10 ** rng.uniform(-3, 2, 3 * n), "x": rng.normal(0, 50, 3 * n),
+            "y": rng.normal(0, 50, 3 * n), "z": np.zeros(3 * n), "nx": rng.normal(0, 1, 3 * n),
+            "ny": rng.normal(0, 1, 3 * n), "nz": rng.normal(0, 1, 3 * n), "time": t_max * rng.random(3 * n)},
+        "interactions": {"shower": np.arange(n), "pdg": np.full(n, 2212), "kinetic_energy": np.full(n, 100.0)},
+    }
+    for dir, columns in tables.items():
+        os.makedirs(os.path.join(run_dir, dir))
+        pq.write_table(pa.table(columns), os.path.join(run_dir, dir, mo.output_types[dir] + ".parquet"))
+    with open(os.path.join(run_dir, "summary.yaml"), "w") as file:
+        file.write("showers: " + str(n) + "\nruntime: 1.5\n")
+
+
+def read_merged(output_dir, dir):
+    base = output_dir + "/merged/" + dir + "/" + mo.output_types[dir]
+    files = [base + ".parquet"] + sorted(glob.glob(base + "_[0-9][0-9][0-9][0-9].parquet"))
+    return pa.concat_tables([pq.read_table(f) for f in files])
+
+
+# A run removed between runs of the merged segments is merged like a changed input,
+# leftovers next to the runs are no runs
+def test_merge_after_removing_a_middle_run(tmp_path):
+    sim = str(tmp_path / "sim")
+    for run, n in enumerate([2, 3, 1, 2]):
+        make_run(sim, run, n)
+    mo.merge([sim])
+    make_run(sim, 4, 2)
+    mo.merge([sim])
+    assert len(mo.read_manifest(sim)["segments"]) == 2
+
+    shutil.rmtree(sim + "/run_2")
+    os.makedirs(sim + "/run_5.partial")
+    mo.merge([sim])
+
+    manifest = mo.read_manifest(sim)
+    assert [entry["run"] for entry in manifest["runs"]] == [0, 1, 3, 4]
+    assert [entry["offset"] for entry in manifest["runs"]] == [0, 2, 5, 7]
+
+    # Same as merging the remaining runs from scratch
+    fresh = str(tmp_path / "fresh")
+    shutil.copytree(sim, fresh, ignore=shutil.ignore_patterns("merged"))
+    mo.merge([fresh])
+    for dir in mo.output_types:
+        merged = read_merged(sim, dir)
+        assert merged.equals(read_merged(fresh, dir))
+        assert set(merged["shower"].to_pylist()) == set(range(9))
+    assert not os.path.exists(mo.part_file(sim, mo.HISTOGRAMS, 2))
+
+
+
+# A run whose times do not fit float32 keeps time at float64 in all segments and
+# dataset partitions, not only in its own
+def test_compact_schema_is_shared_by_all_segments(tmp_path):
+    sim = str(tmp_path / "sim")
+    for run in range(2):
+        make_run(sim, run, 2)
+    mo.merge([sim], compact=True, dataset=True, format={"dictionary": False})
+    assert pq.read_schema(mo.segment_file(sim, "particles", 0)).field("time").type == pa.float32()
+
+    make_run(sim, 2, 2, t_max=100.0)
+    mo.merge([sim])
+
+    assert mo.read_manifest(sim)["keep"] == {"particles": ["time"]}
+    schemas = [pq.read_schema(mo.segment_file(sim, "particles", segment)) for segment in range(2)]
+    assert all(schema.field("time").type == pa.float64() for schema in schemas)
+    assert schemas[0].field("x").type == pa.float32() and schemas[0].equals(schemas[1])
+    for path in glob.glob(mo.dataset_dir(sim, "particles") + "/*/run=*/*.parquet"):
+        assert pq.read_schema(path).field("time").type == pa.float64()
+
+    # The pdg codes are dictionary encoded even without dictionary encoding
+    meta = pq.read_metadata(mo.segment_file(sim, "particles", 0))
+    pdg = [i for i in range(meta.num_columns) if meta.schema.column(i).path == "pdg"][0]
+    assert "RLE_DICTIONARY" in meta.row_group(0).column(pdg).encodings
+
+
+# Row groups of a shower larger than a row group hold no other showers
+def test_large_shower_gets_row_groups_of_its_own(tmp_path):
+    path = str(tmp_path / "merged.parquet")
+    table = pa.table({"shower": pa.array([0] * 250 + [1] * 30 + [2] * 40, pa.int64())})
+    writer = mo.ShowerWriter(pq.ParquetWriter(path, table.schema), 100)
+    # The large shower continues in the next table
+    writer.write(table.slice(0, 120))
+    writer.write(table.slice(120))
+    writer.flush()
+    writer.writer.close()
+
+    meta = pq.read_metadata(path)
+    groups = [(meta.row_group(i).num_rows, meta.row_group(i).column(0).statistics.min,
+        meta.row_group(i).column(0).statistics.max) for i in range(meta.num_row_groups)]
+    assert groups == [(100, 0, 0), (100, 0, 0), (50, 0, 0), (70, 1, 2)]
+    assert writer.index[0] == [0, 2, 0, 250] and writer.index[1] == [3, 3, 250, 280]
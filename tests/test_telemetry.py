@@ -0,0 +1,21 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import telemetry
+
+
+# A run killed by the scheduler watchdog, which signals the process group of the
+# wrapper and C8, still writes its telemetry
+def test_killed_child_writes_telemetry(tmp_path):
+    proc = subprocess.Popen([sys.executable, telemetry.__file__, "--interval", "0.1", str(tmp_path), "--",
+        "sleep", "30"], start_new_session=True)
+    time.sleep(1)
+    os.killpg(proc.pid, signal.SIGTERM)
+
+    assert proc.wait(10) == 128 + signal.SIGTERM
+    summary = (tmp_path / telemetry.SUMMARY).read_text()
+    assert "exit_code: -" + str(int(signal.SIGTERM)) + "\n" in summary
+    assert os.path.isfile(tmp_path / telemetry.SERIES)
@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+# Integrity checks of run and merged outputs that only read summary files and
+# parquet footers: row counts, shower ranges from the row group statistics,
+# schemas across runs and the shower numbering of the merged outputs
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import merge_outputs as mo
+
+
+# Outputs with the same number of rows for every shower
+LONGITUDINAL = tuple(mo.SUMMARY_SUMS)
+
+
+# Rows, schema and shower range of a parquet file from its footer, the range is
+# None if a row group has no statistics
+def read_footer(path):
+    meta = pq.read_metadata(path)
+    footer = {"rows": meta.num_rows, "schema": meta.schema.to_arrow_schema(), "showers": None}
+
+    column = [i for i in range(meta.num_columns) if meta.schema.column(i).path == "shower"]
+    if not column or meta.num_rows == 0:
+        return footer
+
+    low, high = None, None
+    for group in range(meta.num_row_groups):
+        if meta.row_group(group).num_rows == 0:
+            continue
+        stats = meta.row_group(group).column(column[0]).statistics
+        if stats is None or not stats.has_min_max:
+            return footer
+        low = stats.min if low is None else min(low, stats.min)
+        high = stats.max if high is None else max(high, stats.max)
+    footer["showers"] = (low, high)
+    return footer
+
+
+# Check the shower range of a file, all showers present for longitudinal outputs
+def check_showers(name, dir, footer, first, end):
+    if footer["rows"] == 0:
+        return [name + ": no rows"] if dir in LONGITUDINAL and end > first else []
+    if footer["showers"] is None:
+        return [name + ": no shower statistics"]
+
+    low, high = footer["showers"]
+    if dir in LONGITUDINAL and (low, high) != (first, end - 1):
+        return [name + ": showers " + str(low) + "-" + str(high) + ", expected " + str(first) + "-" + str(end - 1)]
+    if low < first or high >= end:
+        return [name + ": showers " + str(low) + "-" + str(high) + " outside of " + str(first) + "-" + str(end - 1)]
+    return []
+
+
+# Summary and output footers of one run, returns (showers, {dir: footer}, issues)
+def check_run(output_dir, run):
+    name = "run_" + str(run)
+    try:
+        n_shw, _ = mo.read_summary(output_dir, run)
+    except (OSError, KeyError, TypeError, ValueError) as error:
+        return None, {}, [name + "/summary.yaml: " + str(error)]
+
+    footers = {}
+    issues = []
+    if n_shw <= 0:
+        issues.append(name + "/summary.yaml: " + str(n_shw) + " showers")
+    for dir, file in mo.output_types.items():
+        path = name + "/" + dir + "/" + file + ".parquet"
+        try:
+            footer = read_footer(output_dir + "/" + path)
+        except (OSError, pa.ArrowException) as error:
+            issues.append(path + ": " + str(error))
+            continue
+        footers[dir] = footer
+
+        # Shower ranges cannot be checked against a summary without showers
+        if n_shw <= 0:
+            continue
+        issues += check_showers(path, dir, footer, 0, n_shw)
+        if dir in LONGITUDINAL and footer["rows"] % n_shw:
+            issues.append(path + ": " + str(footer["rows"]) + " rows are no multiple of " + str(n_shw) + " showers")
+
+    return n_shw, footers, issues
+
+
+# Merged files of a simulation against its runs: shower numbers of each segment
+# follow those of the runs before, and rows add up if nothing changed since the
+# merge. Results of check_run are given by run index.
+def check_merged(output_dir, results):
+    merged = output_dir + "/merged"
+    if not os.path.isdir(merged):
+        return [], []
+
+    # Shower offsets of the runs the merge takes, as the merge leaves out incomplete runs
+    merged_runs = [run for run in sorted(results) if mo.is_complete(output_dir, run)]
+    n_end = merged_runs[-1] + 1 if merged_runs else 0
+    offsets = {}
+    total = 0
+    for run in merged_runs:
+        offsets[run] = total
+        total += results[run][0]
+
+    # First shower of the runs from a run index on
+    def first_shower(index):
+        return min([offsets[run] for run in merged_runs if run >= index] + [total])
+
+    manifest = mo.read_manifest(output_dir)
+    segments = manifest["segments"] or [[0, n_end]]
+
+    issues = []
+    warnings = []
+    known = {entry["run"]: entry for entry in manifest["runs"]}
+    current = sorted(known) == merged_runs
+    for run, entry in known.items():
+        signature = mo.run_signature(output_dir, run) if run in offsets and len(results[run][1]) == len(mo.output_types) else None
+        if signature != {"size": entry["size"], "mtime": entry["mtime"]}:
+            current = False
+    if known and not current:
+        warnings.append("merged/: runs changed since the last merge")
+
+    for dir in mo.output_types:
+        rows = 0
+        # All segments of an output have one schema, a dataset of them reads all as the first
+        schema = None
+        for segment, (first, end) in enumerate(segments):
+            path = mo.segment_file(output_dir, dir, segment)
+            name = os.path.relpath(path, output_dir)
+            if end > n_end:
+                issues.append(name + ": runs " + str(first) + "-" + str(end - 1) + " do not exist")
+                continue
+            try:
+                footer = read_footer(path)
+            except (OSError, pa.ArrowException) as error:
+                issues.append(name + ": " + str(error))
+                continue
+            rows += footer["rows"]
+            issues += check_showers(name, dir, footer, first_shower(first), first_shower(end))
+            if schema is None:
+                schema = (name, footer["schema"])
+            elif not footer["schema"].equals(schema[1]):
+                issues.append(name + ": schema differs from " + schema[0])
+
+        if current:
+            run_rows = sum(results[run][1][dir]["rows"] for run in merged_runs)
+            if rows != run_rows:
+                issues.append("merged/" + dir + ": " + str(rows) + " rows, runs have " + str(run_rows))
+
+    # One row per shower and family of all merged runs
+    path = merged + "/" + mo.HISTOGRAMS + ".parquet"
+    if os.path.isfile(path):
+        name = "merged/" + mo.HISTOGRAMS + ".parquet"
+        try:
+            footer = read_footer(path)
+        except (OSError, pa.ArrowException) as error:
+            return issues + [name + ": " + str(error)], warnings
+        expected = first_shower(min(segments[-1][1], n_end)) * len(mo.HIST_FAMILIES)
+        if footer["rows"] != expected:
+            issues.append(name + ": " + str(footer["rows"]) + " rows, expected " + str(expected))
+
+    return issues, warnings
+
+
+# Schemas of all runs as in the first one and the merged outputs, from the
+# results of check_run by run index
+def check_sim(output_dir, results):
+    issues = [issue for run in sorted(results) for issue in results[run][2]]
+
+    for dir in mo.output_types:
+        schemas = [(run, results[run][1][dir]["schema"]) for run in sorted(results) if dir in results[run][1]]
+        for run, schema in schemas[1:]:
+            if not schema.equals(schemas[0][1]):
+                issues.append("run_" + str(run) + "/" + dir + ": schema differs from run_" + str(schemas[0][0]))
+
+    # Gaps in the run numbers, e.g. of runs removed after they failed
+    warnings = []
+    missing = sorted(set(range(max(results, default=-1) + 1)) - set(results))
+    if missing:
+        warnings.append("missing run(s) " + ", ".join(str(run) for run in missing))
+
+    if any(results[run][0] is None for run in results):
+        return issues, warnings
+    merged_issues, merged_warnings = check_merged(output_dir, results)
+    return issues + merged_issues, warnings + merged_warnings
+
+
+# Simulation directories below the output directory
+def simulations(output_dir):
+    return sorted(name for name in os.listdir(output_dir) if not name.startswith(".")
+        and os.path.isdir(os.path.join(output_dir, name)) and mo.run_indices(os.path.join(output_dir, name)))
+
+
+# Check simulations in parallel and print their issues, returns the number of
+# simulations with issues
+def validate(output_dir, names=None, jobs=None):
+    names = names or simulations(output_dir)
+    dirs = [os.path.join(output_dir, name) for name in names]
+    with ThreadPoolExecutor(jobs or os.cpu_count()) as pool:
+        runs = [{run: pool.submit(check_run, dir, run) for run in mo.run_indices(dir)} for dir in dirs]
+        results = [pool.submit(check_sim, dir, {run: f.result() for run, f in futures.items()})
+            for dir, futures in zip(dirs, runs)]
+        results = [f.result() for f in results]
+
+    n_bad = 0
+    for name, futures, (issues, warnings) in zip(names, runs, results):
+        print("  - ", name, ": ", len(futures), " runs, ", "ok" if not issues else str(len(issues)) + " issue(s)", sep="")
+        for line in issues + ["warning: " + w for w in warnings]:
+            print("      ", line)
+        n_bad += bool(issues)
+    return n_bad